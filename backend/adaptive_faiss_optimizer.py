@@ -4,156 +4,319 @@ Implements query-complexity based optimization for vector search
 """
 
 import logging
+import os
+import sys
 import time
-from enum import Enum
+from collections import deque
+from enum import IntEnum
+from functools import lru_cache
+from types import MappingProxyType
 from typing import Dict, Any, Optional, List
+
+import faiss
+import numpy as np
 from langchain.docstore.document import Document
 
 logger = logging.getLogger(__name__)
 
-class QueryComplexity(Enum):
-    SIMPLE = "simple"
-    MEDIUM = "medium"
-    COMPLEX = "complex"
+class SearchIntent(IntEnum):
+    INFO = 0      # 情報検索（およびその他の意図）
+    FACT = 1      # 事実確認
+    EXPLORE = 2   # 探索的検索
+    COMPARE = 3   # 比較分析
+
+class QueryComplexity(IntEnum):
+    MEDIUM = 0    # 中程度
+    SIMPLE = 1    # 単純
+    COMPLEX = 2   # 複雑
+
+class SearchStrategy(IntEnum):
+    COMPREHENSIVE = 0  # 包括検索
+    PRECISE = 1        # 精密検索
+    EXPLORATORY = 2    # 探索検索
+
+class QueryDomain(IntEnum):
+    GENERAL = 0    # 一般（およびその他のドメイン）
+    TECHNICAL = 1  # 技術
+    ACADEMIC = 2   # 学術
+
+# LLMのクエリ分析結果（日本語ラベル）→ 列挙型。未知のラベルは各列挙型の 0 に寄せる
+_INTENT_MAP = MappingProxyType({
+    "事実確認": SearchIntent.FACT,
+    "探索的検索": SearchIntent.EXPLORE,
+    "比較分析": SearchIntent.COMPARE,
+})
+_COMPLEXITY_MAP = MappingProxyType({
+    "単純": QueryComplexity.SIMPLE,
+    "複雑": QueryComplexity.COMPLEX,
+})
+_STRATEGY_MAP = MappingProxyType({
+    "精密検索": SearchStrategy.PRECISE,
+    "探索検索": SearchStrategy.EXPLORATORY,
+})
+_DOMAIN_MAP = MappingProxyType({
+    "技術": QueryDomain.TECHNICAL,
+    "学術": QueryDomain.ACADEMIC,
+})
+
+# ベースパラメータ
+BASE_SEARCH_PARAMS = MappingProxyType({
+    "search_type": "mmr",
+    "k": 6,
+    "fetch_k": 20,
+    "lambda_mult": 0.5
+})
+
+# 検索意図による調整
+INTENT_OVERRIDES = MappingProxyType({
+    SearchIntent.INFO: MappingProxyType({}),
+    # 事実確認: 精度重視
+    SearchIntent.FACT: MappingProxyType({"k": 3, "fetch_k": 10, "lambda_mult": 0.8}),
+    # 探索的検索: 多様性重視
+    SearchIntent.EXPLORE: MappingProxyType({"k": 10, "fetch_k": 50, "lambda_mult": 0.2}),
+    # 比較分析: バランス重視
+    SearchIntent.COMPARE: MappingProxyType({"k": 8, "fetch_k": 30, "lambda_mult": 0.4}),
+})
+
+# 複雑度による調整 (k, fetch_k) -> (k, fetch_k)
+COMPLEXITY_ADJUSTMENTS = MappingProxyType({
+    QueryComplexity.MEDIUM: lambda k, fetch_k: (k, fetch_k),
+    # 複雑なクエリ: より多くの候補を検討
+    QueryComplexity.COMPLEX: lambda k, fetch_k: (min(k + 2, 15), min(fetch_k * 2, 100)),
+    # 単純なクエリ: 効率重視
+    QueryComplexity.SIMPLE: lambda k, fetch_k: (max(k - 1, 3), max(fetch_k // 2, 5)),
+})
+
+# 検索戦略による lambda_mult の調整
+STRATEGY_LAMBDA_DELTA = MappingProxyType({
+    SearchStrategy.COMPREHENSIVE: lambda lambda_mult: lambda_mult,
+    SearchStrategy.PRECISE: lambda lambda_mult: min(lambda_mult + 0.2, 0.9),
+    SearchStrategy.EXPLORATORY: lambda lambda_mult: max(lambda_mult - 0.2, 0.1),
+})
+
+
+def _build_search_params_table() -> Dict[tuple, MappingProxyType]:
+    """意図×複雑度×戦略の全組み合わせのパラメータをインポート時に確定させる"""
+    table = {}
+    for intent in SearchIntent:
+        for complexity in QueryComplexity:
+            for strategy in SearchStrategy:
+                params = dict(BASE_SEARCH_PARAMS)
+                params.update(INTENT_OVERRIDES[intent])
+                params["k"], params["fetch_k"] = COMPLEXITY_ADJUSTMENTS[complexity](params["k"], params["fetch_k"])
+                params["lambda_mult"] = STRATEGY_LAMBDA_DELTA[strategy](params["lambda_mult"])
+                table[(intent, complexity, strategy)] = MappingProxyType(params)
+    return table
+
+
+_SEARCH_PARAMS_TABLE = _build_search_params_table()
+
+# これ未満のドキュメント数では k / fetch_k をドキュメント数で制限する
+_SMALL_DOC_COUNT = 50
+
+
+# キー空間は 意図×複雑度×戦略×(_SMALL_DOC_COUNT + 1) で有限のため、上限を設けず全て保持する
+@lru_cache(maxsize=None)
+def _cached_search_params(intent: SearchIntent, complexity: QueryComplexity, search_strategy: SearchStrategy, doc_bucket: int) -> MappingProxyType:
+    """(意図, 複雑度, 戦略, ドキュメント数バケット) ごとの検索パラメータをメモ化
+
+    doc_bucket は _SMALL_DOC_COUNT 未満なら実際のドキュメント数（負の値は 0）、それ以上は
+    _SMALL_DOC_COUNT に丸めた値（それ以上ではパラメータが変化しないため）。
+    """
+    params = _SEARCH_PARAMS_TABLE[(intent, complexity, search_strategy)]
+
+    if doc_bucket < _SMALL_DOC_COUNT:
+        # 少数ドキュメント: より厳密に
+        params = dict(params)
+        params["k"] = min(params["k"], doc_bucket // 2 + 1)
+        params["fetch_k"] = min(params["fetch_k"], doc_bucket)
+        params = MappingProxyType(params)
+
+    return params
+
+
+def mmr_select(query_emb: np.ndarray, cand_embs: np.ndarray, k: int, lambda_mult: float = 0.5) -> List[int]:
+    """ベクトル化した MMR (Maximal Marginal Relevance) による候補選択
+
+    LangChain の maximal_marginal_relevance と同じ選択結果を返す。クエリ・候補間
+    および候補同士の類似度を行列演算で一括計算し、Python のループは k 回の
+    argmax のみに抑える。埋め込みは正規化されていなくてもよい（コサイン類似度を使用）。
+
+    Returns:
+        選択された候補のインデックス（選択順）
+    """
+    cand_embs = np.asarray(cand_embs, dtype=np.float32)
+    n = cand_embs.shape[0] if cand_embs.ndim == 2 else 0
+    k = min(k, n)
+    if k <= 0:
+        return []
+
+    query_emb = np.asarray(query_emb, dtype=np.float32).reshape(-1)
+    cand_norms = np.linalg.norm(cand_embs, axis=1, keepdims=True)
+    cand_embs = cand_embs / np.where(cand_norms == 0, 1.0, cand_norms)
+    query_norm = np.linalg.norm(query_emb)
+    if query_norm:
+        query_emb = query_emb / query_norm
+
+    sims_q = cand_embs @ query_emb
+    sims_dd = cand_embs @ cand_embs.T
+
+    selected: List[int] = []
+    selected_mask = np.zeros(n, dtype=bool)
+    max_sim_to_selected = np.full(n, -np.inf, dtype=np.float32)
+
+    # 1件目はクエリとの類似度が最大の候補
+    idx = int(sims_q.argmax())
+    for _ in range(k):
+        selected.append(idx)
+        selected_mask[idx] = True
+        np.maximum(max_sim_to_selected, sims_dd[idx], out=max_sim_to_selected)
+        if len(selected) == k:
+            break
+        scores = lambda_mult * sims_q - (1 - lambda_mult) * max_sim_to_selected
+        scores[selected_mask] = -np.inf
+        idx = int(scores.argmax())
+
+    return selected
+
+
+# HNSW インデックスの構築パラメータ。チャンク数がしきい値未満の場合は
+# 構築コストの方が大きいため、総当たり（IndexFlatL2）のまま検索する
+HNSW_MIN_VECTORS = int(os.getenv("HNSW_MIN_VECTORS", "2000"))
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = 100
+
+# HNSW インデックスに格納するベクトルの形式（"fp16" はメモリ帯域を半分にする）
+_HNSW_QUANTIZERS = MappingProxyType({
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+})
+
+
+def build_hnsw_index(flat_index: Any, quantization: str = "f32") -> Any:
+    """総当たりインデックスのベクトルから同じ L2 距離の HNSW インデックスを構築
+
+    チャンク数が HNSW_MIN_VECTORS 未満の場合は元のインデックスをそのまま返す。
+    距離の尺度は変わらないため、類似度への変換やしきい値はそのまま使える。
+    quantization に "fp16" / "int8" を指定するとスカラー量子化したベクトルを格納する
+    （それ以外は FP32 のまま）。
+    """
+    n = flat_index.ntotal
+    if n < HNSW_MIN_VECTORS:
+        return flat_index
+
+    start = time.perf_counter()
+    vectors = flat_index.reconstruct_n(0, n)
+    qtype = _HNSW_QUANTIZERS.get(quantization)
+    if qtype is None:
+        index = faiss.IndexHNSWFlat(flat_index.d, HNSW_M)
+    else:
+        index = faiss.IndexHNSWSQ(flat_index.d, qtype, HNSW_M)
+        index.train(vectors)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    index.add(vectors)
+    logger.info(f"Built HNSW index ({quantization if qtype is not None else 'f32'}) for {n} vectors in {time.perf_counter() - start:.2f}s")
+    return index
+
+
+# チャンク分割のベース設定
+BASE_CHUNK_CONFIG = MappingProxyType({
+    "chunk_size": 1000,
+    "chunk_overlap": 200
+})
+
+# 検索意図によるチャンクサイズ調整
+CHUNK_INTENT_OVERRIDES = MappingProxyType({
+    # 事実確認: 小さなチャンクで精密に
+    SearchIntent.FACT: MappingProxyType({"chunk_size": 500, "chunk_overlap": 100}),
+    # 探索的検索: 大きなチャンクで文脈を保持
+    SearchIntent.EXPLORE: MappingProxyType({"chunk_size": 1500, "chunk_overlap": 300}),
+})
+
+# 区切り文字（呼び出し間で共有するため不変の tuple とし、文字列は intern しておく）
+_SEP_DEFAULT = tuple(sys.intern(sep) for sep in ("\n\n", "\n", "。", ".", " ", ""))
+# 技術文書: コードブロックやセクションを考慮
+_SEP_TECH = tuple(sys.intern(sep) for sep in ("```", "\n\n", "\n", "。", ".", " ", ""))
+# 学術文書: パラグラフ単位を重視
+_SEP_ACADEMIC = tuple(sys.intern(sep) for sep in ("\n\n", "\n", "。", "．", ".", " ", ""))
+
+# ドメインによる区切り文字
+DOMAIN_SEPARATORS = MappingProxyType({
+    QueryDomain.GENERAL: _SEP_DEFAULT,
+    QueryDomain.TECHNICAL: _SEP_TECH,
+    QueryDomain.ACADEMIC: _SEP_ACADEMIC,
+})
+
 
 class AdaptiveFAISSOptimizer:
     def __init__(self):
-        self.search_history = []
+        self.search_history = deque(maxlen=100)  # 古い履歴は自動的に破棄
         self.performance_metrics = {}
-        
-    
+
+
     def get_adaptive_search_params(self, query_analysis: Dict[str, Any], doc_count: int) -> Dict[str, Any]:
-        """クエリ分析に基づく動的検索パラメータ調整"""
-        
+        """クエリ分析に基づく動的検索パラメータ調整
+
+        戻り値の partial_sort_k は、fetch_k 件の候補から上位 k 件だけを取り出す
+        利用側への部分ソートのヒント。全件を argsort する代わりに
+        ``idx = np.argpartition(-scores, k)[:k]; idx = idx[np.argsort(-scores[idx])]``
+        とすれば O(n) で済む。ヒントを無視する利用側の動作は変わらない。
+        """
+
         try:
             intent = query_analysis.get('intent', '情報検索')
             complexity = query_analysis.get('complexity', '中程度')
             search_strategy = query_analysis.get('search_strategy', '包括検索')
-            
-            # ベースパラメータ
-            base_params = {
-                "search_type": "mmr",
-                "k": 6,
-                "fetch_k": 20,
-                "lambda_mult": 0.5
-            }
-            
-            # 検索意図による調整
-            if intent == "事実確認":
-                # 事実確認: 精度重視
-                base_params.update({
-                    "k": 3,
-                    "fetch_k": 10,
-                    "lambda_mult": 0.8  # 関連性重視
-                })
-            elif intent == "探索的検索":
-                # 探索的検索: 多様性重視
-                base_params.update({
-                    "k": 10,
-                    "fetch_k": 50,
-                    "lambda_mult": 0.2  # 多様性重視
-                })
-            elif intent == "比較分析":
-                # 比較分析: バランス重視
-                base_params.update({
-                    "k": 8,
-                    "fetch_k": 30,
-                    "lambda_mult": 0.4
-                })
-            
-            # 複雑度による調整
-            if complexity == "複雑":
-                # 複雑なクエリ: より多くの候補を検討
-                base_params["fetch_k"] = min(base_params["fetch_k"] * 2, 100)
-                base_params["k"] = min(base_params["k"] + 2, 15)
-            elif complexity == "単純":
-                # 単純なクエリ: 効率重視
-                base_params["fetch_k"] = max(base_params["fetch_k"] // 2, 5)
-                base_params["k"] = max(base_params["k"] - 1, 3)
-            
-            # 検索戦略による調整
-            if search_strategy == "精密検索":
-                base_params["lambda_mult"] = min(base_params["lambda_mult"] + 0.2, 0.9)
-            elif search_strategy == "探索検索":
-                base_params["lambda_mult"] = max(base_params["lambda_mult"] - 0.2, 0.1)
-            
-            # ドキュメント数による調整
-            if doc_count < 50:
-                # 少数ドキュメント: より厳密に
-                base_params["k"] = min(base_params["k"], doc_count // 2 + 1)
-                base_params["fetch_k"] = min(base_params["fetch_k"], doc_count)
-            
-            logger.info(f"Adaptive FAISS params: {base_params}")
-            logger.info(f"  Based on: {intent}/{complexity}/{search_strategy}, docs={doc_count}")
-            
+
+            base_params = dict(_cached_search_params(
+                _INTENT_MAP.get(intent, SearchIntent.INFO),
+                _COMPLEXITY_MAP.get(complexity, QueryComplexity.MEDIUM),
+                _STRATEGY_MAP.get(search_strategy, SearchStrategy.COMPREHENSIVE),
+                min(max(doc_count, 0), _SMALL_DOC_COUNT)
+            ))
+            base_params["partial_sort_k"] = base_params["k"]
+
+            # クエリごとに呼ばれるため、INFO が無効な場合は整形自体を行わない
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Adaptive FAISS params: %s", base_params)
+                logger.info("  Based on: %s/%s/%s, docs=%d", intent, complexity, search_strategy, doc_count)
+
             return base_params
-            
+
         except Exception as e:
             logger.error(f"Error generating adaptive search params: {e}")
-            return {
-                "search_type": "mmr",
-                "k": 6,
-                "fetch_k": 20,
-                "lambda_mult": 0.5
-            }
-    
+            return dict(BASE_SEARCH_PARAMS)
+
     def optimize_chunk_strategy(self, analysis: Dict[str, Any]) -> Dict[str, Any]:
         """クエリ分析に基づくドキュメント分割戦略の最適化"""
-        
+
         try:
-            intent = analysis.get('intent', '情報検索')
-            complexity = analysis.get('complexity', '中程度')
-            domain = analysis.get('domain', '一般')
-            
-            # ベース設定
-            chunk_config = {
-                "chunk_size": 1000,
-                "chunk_overlap": 200,
-                "separators": ["\n\n", "\n", "。", ".", " ", ""]
-            }
-            
-            # 検索意図による調整
-            if intent == "事実確認":
-                # 事実確認: 小さなチャンクで精密に
-                chunk_config.update({
-                    "chunk_size": 500,
-                    "chunk_overlap": 100
-                })
-            elif intent == "探索的検索":
-                # 探索的検索: 大きなチャンクで文脈を保持
-                chunk_config.update({
-                    "chunk_size": 1500,
-                    "chunk_overlap": 300
-                })
-            
+            intent = _INTENT_MAP.get(analysis.get('intent', '情報検索'), SearchIntent.INFO)
+            complexity = _COMPLEXITY_MAP.get(analysis.get('complexity', '中程度'), QueryComplexity.MEDIUM)
+            domain = _DOMAIN_MAP.get(analysis.get('domain', '一般'), QueryDomain.GENERAL)
+
+            # ベース設定 + 検索意図による調整
+            chunk_config = dict(BASE_CHUNK_CONFIG)
+            chunk_config.update(CHUNK_INTENT_OVERRIDES.get(intent, {}))
+
             # 複雑度による調整
-            if complexity == "複雑":
+            if complexity is QueryComplexity.COMPLEX:
                 # 複雑なクエリ: オーバーラップを増やして文脈を保持
                 chunk_config["chunk_overlap"] = min(chunk_config["chunk_overlap"] * 1.5, chunk_config["chunk_size"] // 2)
-            
+
             # ドメインによる調整
-            if domain == "技術":
-                # 技術文書: コードブロックやセクションを考慮
-                chunk_config["separators"] = ["```", "\n\n", "\n", "。", ".", " ", ""]
-            elif domain == "学術":
-                # 学術文書: パラグラフ単位を重視
-                chunk_config["separators"] = ["\n\n", "\n", "。", "．", ".", " ", ""]
-            
-            logger.info(f"Optimized chunk strategy: {chunk_config}")
+            chunk_config["separators"] = DOMAIN_SEPARATORS[domain]
+
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Optimized chunk strategy: %s", chunk_config)
             return chunk_config
-            
+
         except Exception as e:
             logger.error(f"Error optimizing chunk strategy: {e}")
             return {
                 "chunk_size": 1000,
                 "chunk_overlap": 200,
-                "separators": ["\n\n", "\n", "。", ".", " ", ""]
+                "separators": _SEP_DEFAULT
             }
-    
-    
-    
-    
-    
-    
-    
-    
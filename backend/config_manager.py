@@ -2,18 +2,38 @@
 Configuration Manager for Excluded Folders
 """
 
-import json
 import os
-from typing import List, Dict, Any, Optional
+import time
+from typing import List, Dict, Any, Optional, Tuple, FrozenSet
 from datetime import datetime
 import logging
 
+import orjson
+
 logger = logging.getLogger(__name__)
 
+# (秒単位のUNIX時刻, ISO形式の文字列) - 同じ秒の間は整形済み文字列を使い回す
+_iso_timestamp_cache = (0, "")
+
+def _now_iso() -> str:
+    """現在時刻のISO形式文字列を取得（秒単位でキャッシュ）"""
+    global _iso_timestamp_cache
+    now = int(time.time())
+    if _iso_timestamp_cache[0] != now:
+        _iso_timestamp_cache = (now, datetime.fromtimestamp(now).isoformat())
+    return _iso_timestamp_cache[1]
+
 class ExcludedFoldersConfig:
     def __init__(self, config_file_path: str = "./config/excluded_folders.json"):
         self.config_file_path = config_file_path
         self.config_data = {}
+        self._folders_by_id: Dict[str, Dict[str, Any]] = {}
+        # 有効な除外フォルダIDの集合（追加・削除・切り替えのたびに同期する）
+        self._enabled_ids: set = set()
+        # 変更のたびに増加するバージョン番号と、有効な除外フォルダIDのキャッシュ
+        self._version = 0
+        self._folder_ids_cache: Optional[Tuple[str, ...]] = None
+        self._folder_ids_set_cache: Optional[FrozenSet[str]] = None
         self._ensure_config_dir()
         self.load_config()
     
@@ -32,8 +52,9 @@ class ExcludedFoldersConfig:
                 self._create_default_config()
                 return True
             
-            with open(self.config_file_path, 'r', encoding='utf-8') as f:
-                self.config_data = json.load(f)
+            with open(self.config_file_path, 'rb') as f:
+                self.config_data = orjson.loads(f.read())
+            self._rebuild_folder_index()
             
             logger.info(f"Loaded excluded folders config with {len(self.get_excluded_folder_ids())} folders")
             return True
@@ -53,22 +74,53 @@ class ExcludedFoldersConfig:
                 "max_excluded_folders": 50,
                 "similarity_threshold": 0.5,
                 "enable_final_relevance_check": True,
-                "max_documents_for_relevance_check": 15
+                "max_documents_for_relevance_check": 15,
+                "search_cache_enabled": True,
+                "embed_quant": "f32"
             },
-            "last_updated": datetime.now().isoformat(),
+            "last_updated": _now_iso(),
             "version": "1.0"
         }
         
         self.config_data = default_config
+        self._rebuild_folder_index()
         self.save_config()
     
+    def _rebuild_folder_index(self):
+        """フォルダID -> フォルダ情報のインデックスを構築（保存時はリストとして書き出す）"""
+        self._folders_by_id = {
+            folder["id"]: folder
+            for folder in self.config_data.get("excluded_folders", [])
+            if folder.get("id")
+        }
+        self._enabled_ids = {
+            folder_id for folder_id, folder in self._folders_by_id.items()
+            if folder.get("enabled", True)
+        }
+        self._invalidate()
+    
+    def _invalidate(self):
+        """派生キャッシュを破棄してバージョンを進める"""
+        self._version += 1
+        self._folder_ids_cache = None
+        self._folder_ids_set_cache = None
+    
+    @property
+    def version(self) -> int:
+        """設定の変更ごとに増加するバージョン番号"""
+        return self._version
+    
     def save_config(self) -> bool:
         """設定ファイルを保存"""
         try:
-            self.config_data["last_updated"] = datetime.now().isoformat()
+            self.config_data["excluded_folders"] = list(self._folders_by_id.values())
+            self.config_data["last_updated"] = _now_iso()
             
-            with open(self.config_file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.config_data, f, indent=2, ensure_ascii=False)
+            # 一時ファイルに書き出してから置き換え、書き込み途中のクラッシュで設定が壊れないようにする
+            tmp_path = self.config_file_path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(self.config_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+            os.replace(tmp_path, self.config_file_path)
             
             logger.info(f"Saved excluded folders config to {self.config_file_path}")
             return True
@@ -77,35 +129,53 @@ class ExcludedFoldersConfig:
             logger.error(f"Error saving config file: {e}")
             return False
     
-    def get_excluded_folder_ids(self) -> List[str]:
-        """有効な除外フォルダIDのリストを取得"""
-        try:
-            excluded_folders = self.config_data.get("excluded_folders", [])
-            return [
-                folder["id"] 
-                for folder in excluded_folders 
-                if folder.get("enabled", True) and folder.get("id")
-            ]
-        except Exception as e:
-            logger.error(f"Error getting excluded folder IDs: {e}")
-            return []
+    def _save_change(self):
+        """変更を反映して派生キャッシュを破棄し、設定ファイルに保存"""
+        self._invalidate()
+        self.save_config()
+    
+    def get_excluded_folder_ids(self) -> Tuple[str, ...]:
+        """有効な除外フォルダIDのタプルを取得（変更があるまでキャッシュを共有）"""
+        if self._folder_ids_cache is not None:
+            return self._folder_ids_cache
+        
+        self._folder_ids_cache = tuple(
+            folder_id
+            for folder_id, folder in self._folders_by_id.items()
+            if folder.get("enabled", True)
+        )
+        return self._folder_ids_cache
+    
+    def get_excluded_folder_ids_set(self) -> FrozenSet[str]:
+        """有効な除外フォルダIDの集合を取得（所属判定用、変更があるまでキャッシュを共有）"""
+        if self._folder_ids_set_cache is None:
+            self._folder_ids_set_cache = frozenset(self._enabled_ids)
+        return self._folder_ids_set_cache
+    
+    def is_folder_excluded(self, folder_id: str) -> bool:
+        """フォルダが有効な除外対象かチェック"""
+        return folder_id in self._enabled_ids
+    
+    @property
+    def excluded_count(self) -> int:
+        """有効な除外フォルダの数"""
+        return len(self._enabled_ids)
     
     def get_excluded_folders(self) -> List[Dict[str, Any]]:
         """除外フォルダの完全な情報を取得"""
-        return self.config_data.get("excluded_folders", [])
+        return list(self._folders_by_id.values())
     
     def add_excluded_folder(self, folder_id: str, name: str = "", description: str = "", enabled: bool = True) -> bool:
         """除外フォルダを追加"""
         try:
             # 既存チェック
-            existing_ids = [f["id"] for f in self.config_data.get("excluded_folders", [])]
-            if folder_id in existing_ids:
+            if folder_id in self._folders_by_id:
                 logger.warning(f"Folder {folder_id} already in excluded list")
                 return False
             
             # 最大数チェック
             max_folders = self.config_data.get("settings", {}).get("max_excluded_folders", 50)
-            if len(existing_ids) >= max_folders:
+            if len(self._folders_by_id) >= max_folders:
                 logger.error(f"Maximum excluded folders limit reached: {max_folders}")
                 return False
             
@@ -114,14 +184,13 @@ class ExcludedFoldersConfig:
                 "name": name or f"Folder {folder_id[:8]}",
                 "description": description,
                 "enabled": enabled,
-                "added_date": datetime.now().isoformat()
+                "added_date": _now_iso()
             }
             
-            if "excluded_folders" not in self.config_data:
-                self.config_data["excluded_folders"] = []
-            
-            self.config_data["excluded_folders"].append(new_folder)
-            self.save_config()
+            self._folders_by_id[folder_id] = new_folder
+            if enabled:
+                self._enabled_ids.add(folder_id)
+            self._save_change()
             
             logger.info(f"Added excluded folder: {folder_id} ({name})")
             return True
@@ -133,15 +202,9 @@ class ExcludedFoldersConfig:
     def remove_excluded_folder(self, folder_id: str) -> bool:
         """除外フォルダを削除"""
         try:
-            excluded_folders = self.config_data.get("excluded_folders", [])
-            original_count = len(excluded_folders)
-            
-            self.config_data["excluded_folders"] = [
-                f for f in excluded_folders if f.get("id") != folder_id
-            ]
-            
-            if len(self.config_data["excluded_folders"]) < original_count:
-                self.save_config()
+            if self._folders_by_id.pop(folder_id, None) is not None:
+                self._enabled_ids.discard(folder_id)
+                self._save_change()
                 logger.info(f"Removed excluded folder: {folder_id}")
                 return True
             else:
@@ -155,14 +218,16 @@ class ExcludedFoldersConfig:
     def toggle_excluded_folder(self, folder_id: str) -> Optional[bool]:
         """除外フォルダの有効/無効を切り替え"""
         try:
-            excluded_folders = self.config_data.get("excluded_folders", [])
-            
-            for folder in excluded_folders:
-                if folder.get("id") == folder_id:
-                    folder["enabled"] = not folder.get("enabled", True)
-                    self.save_config()
-                    logger.info(f"Toggled folder {folder_id} to {'enabled' if folder['enabled'] else 'disabled'}")
-                    return folder["enabled"]
+            folder = self._folders_by_id.get(folder_id)
+            if folder is not None:
+                folder["enabled"] = not folder.get("enabled", True)
+                if folder["enabled"]:
+                    self._enabled_ids.add(folder_id)
+                else:
+                    self._enabled_ids.discard(folder_id)
+                self._save_change()
+                logger.info(f"Toggled folder {folder_id} to {'enabled' if folder['enabled'] else 'disabled'}")
+                return folder["enabled"]
             
             logger.warning(f"Folder {folder_id} not found in excluded list")
             return None
@@ -187,6 +252,14 @@ class ExcludedFoldersConfig:
         """関連性チェック対象の最大ドキュメント数を取得"""
         return self.config_data.get("settings", {}).get("max_documents_for_relevance_check", 15)
     
+    def is_search_cache_enabled(self) -> bool:
+        """検索結果キャッシュが有効かチェック"""
+        return self.config_data.get("settings", {}).get("search_cache_enabled", True)
+    
+    def get_embed_quant(self) -> str:
+        """HNSWインデックスに格納するベクトルの形式を取得（f32 / fp16 / int8）"""
+        return self.config_data.get("settings", {}).get("embed_quant", "f32")
+    
     def get_settings(self) -> Dict[str, Any]:
         """設定情報を取得"""
         return self.config_data.get("settings", {})
@@ -198,7 +271,7 @@ class ExcludedFoldersConfig:
                 self.config_data["settings"] = {}
             
             self.config_data["settings"].update(settings)
-            self.save_config()
+            self._save_change()
             
             logger.info(f"Updated settings: {settings}")
             return True
@@ -207,5 +280,18 @@ class ExcludedFoldersConfig:
             logger.error(f"Error updating settings: {e}")
             return False
 
-# グローバルインスタンス
-excluded_folders_config = ExcludedFoldersConfig()
\ No newline at end of file
+# グローバルインスタンス（初回アクセス時に生成し、import 時のディスクI/Oを避ける）
+_excluded_folders_config: Optional[ExcludedFoldersConfig] = None
+
+def get_excluded_folders_config() -> ExcludedFoldersConfig:
+    """除外フォルダ設定のグローバルインスタンスを取得"""
+    global _excluded_folders_config
+    if _excluded_folders_config is None:
+        _excluded_folders_config = ExcludedFoldersConfig()
+    return _excluded_folders_config
+
+def __getattr__(name: str) -> Any:
+    # 既存の `from config_manager import excluded_folders_config` との互換性を保つ
+    if name == "excluded_folders_config":
+        return get_excluded_folders_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -3,78 +3,655 @@ Advanced LLM Query Generator with AGR (Analyze-Generate-Refine) Framework
 Implements state-of-the-art query expansion and refinement techniques
 """
 
-import json
+import os
 import time
 import asyncio
-from typing import List, Dict, Any, Optional
+import copy
+import hashlib
+import random
+import re
+from collections import OrderedDict, deque
+from itertools import chain
+from typing import List, Dict, Any, Optional, Tuple
 import logging
-from langchain.prompts import PromptTemplate
+
+import numpy as np
+from langchain_core.messages import HumanMessage, SystemMessage
+import orjson
+from pydantic_core import from_json
+from semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
+
+def _result_score(item: Any) -> float:
+    """検索結果から類似度スコアを取り出す（スコアが無い場合は NaN）"""
+    metadata = getattr(item, "metadata", None)
+    if metadata is None:
+        metadata = item if isinstance(item, dict) else {}
+    score = metadata.get("similarity_score", metadata.get("score"))
+    try:
+        return float(score) if score is not None else np.nan
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _results_fingerprint(results: List) -> str:
+    """初回検索結果の識別子からキャッシュ用のダイジェストを生成"""
+    digest = hashlib.blake2b(digest_size=8)
+    for item in results:
+        metadata = getattr(item, "metadata", None)
+        if metadata is None:
+            metadata = item if isinstance(item, dict) else {}
+        key = metadata.get("id") or metadata.get("url") or metadata.get("source") or str(item)[:200]
+        digest.update(str(key).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+_JSON_WHITESPACE = frozenset(" \t\r\n")
+_JSON_CLOSERS = frozenset("}]")
+
+
+def _extract_json_block(s: str) -> str:
+    """LLMの出力から最初の JSON オブジェクトを1回の走査で取り出す
+
+    コードフェンスを読み飛ばし、文字列の内外を追跡しながら括弧の深さを数えて
+    最初に閉じた {...} を返す。同じ走査の中で、文字列外の空白、閉じ括弧直前の
+    カンマ、空の配列要素（[, や ,,）を取り除き、文字列内の生の改行・タブは
+    空白に置き換える。
+    """
+    s = s.strip()
+    if s.startswith("```"):
+        s = s[7:] if s.startswith("```json") else s[3:]
+
+    start = s.find("{")
+    if start < 0:
+        return s.removesuffix("```").strip()
+
+    out: List[str] = []
+    depth = 0
+    in_string = False
+    escaped = False
+    pending_comma = False
+
+    for ch in s[start:]:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            elif ch in _JSON_WHITESPACE:
+                ch = " "
+            out.append(ch)
+            continue
+
+        if ch in _JSON_WHITESPACE:
+            continue
+        if ch == ",":
+            pending_comma = True
+            continue
+
+        if ch in _JSON_CLOSERS:
+            # 閉じ括弧直前のカンマは捨てる
+            pending_comma = False
+            out.append(ch)
+            depth -= 1
+            if depth == 0:
+                break
+            continue
+
+        if pending_comma:
+            # 開き括弧直後やカンマの連続による空要素は捨てる
+            if out and out[-1] not in "[{":
+                out.append(",")
+            pending_comma = False
+
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        out.append(ch)
+
+    return "".join(out)
+
+
+# 部分的な解析結果を採用するために必要な、いずれかのレスポンスキー
+_EXPECTED_RESPONSE_KEYS = frozenset((
+    "primary_keywords", "secondary_keywords", "context_keywords", "negative_keywords",
+    "decomposed_queries", "perspective_queries", "specific_queries", "general_queries",
+    "temporal_queries", "causal_queries", "all_queries", "refined_queries", "complementary_queries",
+    "intent", "complexity", "domain", "search_strategy", "key_concepts",
+))
+
+
+# LLMが配列末尾などに紛れ込ませる不正な文字列（"Farrago." など）の除去パターン
+# 厳密な解析に失敗した場合にのみ適用する
+_JUNK_TOKEN_PATTERNS = (
+    # 配列末尾の不正な文字列（直前のカンマの有無を問わない）
+    (re.compile(r',?\s*[A-Z][a-z]+\.\s*"?\s*\]'), ']'),
+    # 配列内の不正な要素
+    (re.compile(r',\s*"[A-Z][a-z]+\."|"[A-Z][a-z]+\.",?\s*'), ''),
+)
+
+
+def _strip_junk_tokens(content: str) -> str:
+    """LLMが生成する不正な文字列を除去し、構造を再正規化する"""
+    for pattern, replacement in _JUNK_TOKEN_PATTERNS:
+        content = pattern.sub(replacement, content)
+    return _extract_json_block(content)
+
+
+# プロンプトテンプレート（str.format_map で埋め込む。リテラルの { } は {{ }} でエスケープ）
+# AGR Step 1: クエリ分析
+# 固定の指示は SystemMessage にまとめ、リクエスト間でバイト単位で同一に保つ
+# （プロバイダ側のプロンプト/KVキャッシュで静的な先頭部分のプリフィルを再利用させる）
+_ANALYSIS_SYSTEM = SystemMessage(content="""あなたは検索クエリ分析の専門家です。ユーザーメッセージとして与えられる検索クエリを詳細に分析してください。
+
+以下の観点で分析し、JSON形式で出力してください：
+
+厳密にJSON形式のみ出力：
+{
+    "intent": "情報検索|問題解決|比較分析|事実確認|探索的検索",
+    "complexity": "単純|中程度|複雑",
+    "time_constraint": "最新|期間指定|時系列|なし",
+    "required_sources": ["google_drive", "chrome_history", "web_content"],
+    "search_scope": "狭い|中程度|広い",
+    "domain": "技術|ビジネス|学術|一般|専門分野",
+    "key_concepts": ["概念1", "概念2"],
+    "search_strategy": "精密検索|探索検索|包括検索"
+}""")
+
+_ANALYSIS_PROMPT = '# ユーザークエリ\n"{query}"'
+
+# AGR Step 2: 階層的キーワード生成
+# 検索戦略ごとに特化した各階層の指示（該当する戦略の指示だけを送る）
+_KEYWORD_TIER_GUIDANCE = {
+    "精密検索": {
+        "primary_keywords": "AND検索で使用、固有名詞・専門用語を優先して2-3個",
+        "secondary_keywords": "OR検索で使用、必須キーワードの同義語・表記揺れに限定して3-5個",
+        "context_keywords": "対象を絞り込む補完キーワード2-3個",
+        "negative_keywords": "紛らわしい同名・類似の話題を除外する1-3個",
+    },
+    "探索検索": {
+        "primary_keywords": "AND検索で使用、中心となる概念を1-3個",
+        "secondary_keywords": "OR検索で使用、周辺分野や上位・下位概念まで広げて6-10個",
+        "context_keywords": "新たな切り口を与える補完キーワード4-6個",
+        "negative_keywords": "明らかに無関係な結果を除外する0-2個",
+    },
+    "包括検索": {
+        "primary_keywords": "AND検索で使用、最も重要な2-4個",
+        "secondary_keywords": "OR検索で使用、関連概念や同義語5-8個",
+        "context_keywords": "文脈理解を助ける補完キーワード3-5個",
+        "negative_keywords": "無関係な結果を除外する1-3個",
+    },
+}
+
+_KEYWORD_TIER_LABELS = {
+    "primary_keywords": "必須キーワード",
+    "secondary_keywords": "関連キーワード",
+    "context_keywords": "文脈キーワード",
+    "negative_keywords": "除外キーワード",
+}
+
+
+def _keyword_tier_system(tier: str, guidance: str) -> SystemMessage:
+    """キーワード階層1つ分だけを生成させる SystemMessage を構築"""
+    label = _KEYWORD_TIER_LABELS[tier]
+    # 必須キーワードのプロンプトでは検索の確信度も併せて出力させる
+    confidence = ',\n    "search_confidence": 0.8' if tier == "primary_keywords" else ""
+    return SystemMessage(content=f"""あなたは高度な検索キーワード戦略の専門家です。ユーザーメッセージとして与えられるクエリと分析結果に基づいて、{label} ({tier}) を生成してください。
+
+{label}: {guidance}
+
+各キーワードは検索効率を考慮し、フレーズは2-3語以内に抑えてください。
+
+厳密にJSON形式のみ出力：
+{{
+    "{tier}": ["{label}1", "{label}2"]{confidence}
+}}""")
+
+
+# (検索戦略, 階層) -> SystemMessage。4つの階層は並行して生成する
+_KEYWORD_TIER_SYSTEMS = {
+    (strategy, tier): _keyword_tier_system(tier, guidance)
+    for strategy, tiers in _KEYWORD_TIER_GUIDANCE.items()
+    for tier, guidance in tiers.items()
+}
+
+_KEYWORD_PROMPT = """# 元のクエリ
+"{query}"
+
+# 分析結果
+検索意図: {intent}
+複雑度: {complexity}
+ドメイン: {domain}
+検索戦略: {strategy}
+主要概念: {concepts}"""
+
+# AGR Step 3: 多角的RAG検索クエリ生成（戦略ごとに3つの小さなプロンプトへ分割し並行実行）
+_MULTI_PERSPECTIVE_HEADER = """あなたはRAG検索の専門家です。以下のユーザークエリに対して、多角的で効果的な検索クエリを生成してください。
+                ただし，検索クエリがgoogle検索のようにならないように気を付けてください．例えば「応用例」という言葉は，広い言葉で便利に感じますが，ドキュメント内で実際に「応用例」という言葉を使っているものは少ないです．
+                この場合，考えられる応用例をあなたが考えてクエリに含める方が効果的です．
+
+                # 元のクエリ
+                "{original_question}"
+
+                以下の戦略を組み合わせて、多様で効果的な検索クエリを生成してください：
+"""
+
+_MULTI_PERSPECTIVE_PROMPTS = (
+    # クエリ分解 + 観点変更
+    _MULTI_PERSPECTIVE_HEADER + """                1. クエリ分解: 複雑なクエリを構成要素に分割
+                2. 観点変更: 異なる視点から同じ情報を探索
+
+                厳密にJSON形式で出力：
+                {{
+                    "decomposed_queries": ["分解クエリ1", "分解クエリ2"],
+                    "perspective_queries": ["視点変更クエリ1", "視点変更クエリ2"],
+                    "all_queries": ["統合された全クエリリスト"]
+                }}""",
+    # 具体化 + 一般化
+    _MULTI_PERSPECTIVE_HEADER + """                1. 具体化: 抽象的な概念を具体例で検索
+                2. 一般化: 具体的な質問をより広い概念で検索
+
+                厳密にJSON形式で出力：
+                {{
+                    "specific_queries": ["具体化クエリ1", "具体化クエリ2"],
+                    "general_queries": ["一般化クエリ1", "一般化クエリ2"],
+                    "all_queries": ["統合された全クエリリスト"]
+                }}""",
+    # 時系列 + 因果関係
+    _MULTI_PERSPECTIVE_HEADER + """                1. 時系列: 時間軸を考慮した検索
+                2. 因果関係: 原因と結果の両面から検索
+
+                厳密にJSON形式で出力：
+                {{
+                    "temporal_queries": ["時系列クエリ1"],
+                    "causal_queries": ["因果関係クエリ1"],
+                    "all_queries": ["統合された全クエリリスト"]
+                }}""",
+)
+
+# AGR Refine: 初回結果に基づくクエリ改善
+_REFINE_PROMPT = """あなたは検索改善の専門家です。初回検索結果を分析し、より効果的なクエリを生成してください。
+
+                # 元のクエリ
+                "{original_query}"
+
+                # 初回検索結果の分析
+                結果数: {result_count}
+                関連性: {relevance_score}
+                カバレッジ: {coverage_analysis}
+                不足している要素: {missing_elements}
+
+                初回結果の課題を踏まえ、以下の改善策を適用したクエリを生成してください：
+                1. 不足要素を補完するクエリ
+                2. より具体的な検索クエリ
+                3. 異なる角度からのアプローチ
+                4. 関連性を高めるためのクエリ
+
+                厳密にJSON形式で出力：
+                {{
+                    "refined_queries": ["改善クエリ1", "改善クエリ2"],
+                    "complementary_queries": ["補完クエリ1", "補完クエリ2"],
+                    "specific_queries": ["具体化クエリ1", "具体化クエリ2"],
+                    "alternative_queries": ["代替クエリ1", "代替クエリ2"],
+                    "all_queries": ["全改善クエリリスト"]
+                }}"""
+
+# 短い単純なクエリは LLM を呼ばずに定型のバリエーションで検索する
+_TRIVIAL_QUERY_MAX_CHARS = int(os.getenv("TRIVIAL_QUERY_MAX_CHARS", "8"))
+_FALLBACK_QUERY_TEMPLATES = (
+    "{q}",
+    "{q}とは",
+    "{q} 概要",
+    "{q} 具体例",
+    "{q} 課題",
+)
+
+
+def _is_trivial_query(query: str) -> bool:
+    """LLMによる多角的クエリ生成の効果が薄い短いクエリかどうか"""
+    return len(query.split()) <= 2 and len(query.strip()) <= _TRIVIAL_QUERY_MAX_CHARS
+
+
+def _fallback_rag_queries(query: str) -> List[str]:
+    """定型テンプレートによるRAG検索クエリ"""
+    q = query.strip()
+    return [template.format(q=q) for template in _FALLBACK_QUERY_TEMPLATES]
+
+
+# 短いクエリはラベル説明文との埋め込み類似度でローカルに分類し、LLMによる分析を省略する
+_LOCAL_ANALYSIS_MAX_CHARS = int(os.getenv("LOCAL_ANALYSIS_MAX_CHARS", "32"))
+# 1位と2位の類似度差がこれ未満なら判定に自信が無いものとして LLM に回す
+_LOCAL_ANALYSIS_MARGIN = float(os.getenv("LOCAL_ANALYSIS_MARGIN", "0.05"))
+_INTENT_LABELS = {
+    "情報検索": "ある話題についての情報や解説を調べたい",
+    "問題解決": "エラーや困りごとの解決方法・やり方を知りたい",
+    "比較分析": "複数の選択肢の違いや長所・短所を比較したい",
+    "事実確認": "特定の事実・数値・日付が正しいか確認したい",
+    "探索的検索": "関連する話題やアイデアを幅広く探したい",
+}
+_DOMAIN_LABELS = {
+    "技術": "プログラミング、ソフトウェア、システム、エンジニアリングに関する話題",
+    "ビジネス": "仕事、経営、営業、マーケティング、会議に関する話題",
+    "学術": "研究、論文、学会、理論、実験に関する話題",
+    "一般": "日常生活、趣味、ニュースなど一般的な話題",
+}
+_INTENT_STRATEGY = {"事実確認": "精密検索", "探索的検索": "探索検索"}
+
+
+def _is_locally_classifiable(query: str) -> bool:
+    """埋め込みによるローカル分類で十分な短い単文クエリかどうか"""
+    q = query.strip()
+    return len(q) <= _LOCAL_ANALYSIS_MAX_CHARS and sum(q.count(c) for c in "、。,?？") <= 1
+
+
+def _pick_label(labels: Dict[str, str], label_matrix: np.ndarray, emb: np.ndarray) -> Optional[str]:
+    """最も類似するラベルを返す（2位との差が小さい場合は None）"""
+    sims = label_matrix @ emb[0]
+    top, second = np.argsort(sims)[::-1][:2]
+    if sims[top] - sims[second] < _LOCAL_ANALYSIS_MARGIN:
+        return None
+    return list(labels)[top]
+
+
+# 明確な手がかりを含むクエリはルールで即座に分類し、埋め込みもLLMも使わない
+_FAST_COMPARE_RE = re.compile(r"比較|違い|どっち|どちら|\bvs\.?(?=\s|$)|\bversus\b", re.IGNORECASE)
+_FAST_PROBLEM_RE = re.compile(
+    r"エラー|できない|解決(?:方法|策|法|したい|する方法|できない|しない)|直し方|やり方|対処"
+    r"|\berror\b|\bhow to\b|\bfix\b",
+    re.IGNORECASE
+)
+# 疑問詞は疑問・文末の形のみ（「いつも」「どこか」「誰も」「何年も」などは対象外）
+_FAST_FACT_RE = re.compile(
+    r"いつ(?:から|まで)(?!も)|いつ(?:に|頃|ごろ|です|だ|[?？]|$)"
+    r"|どこ(?:で|に|へ|から)(?!も)|どこ(?:です|だ|[?？]|$)"
+    r"|誰(?:が|の|に|を|と|です|だ|[?？]|$)"
+    r"|何年(?!も)|いくら(?!でも|か)"
+    r"|^\s*(?:when|who|where)\b",
+    re.IGNORECASE
+)
+_FAST_RECENT_RE = re.compile(r"最新|最近|今日|今年|\blatest\b|\brecent\b|\btoday\b", re.IGNORECASE)
+
+
+def _fast_intent_classify(query: str) -> Optional[Dict[str, Any]]:
+    """手がかり語や長さから確信を持って分類できるクエリの分析結果を返す（判定できなければ None）"""
+    q = query.strip()
+    if not q:
+        return None
+
+    if _FAST_COMPARE_RE.search(q):
+        intent, complexity = "比較分析", "中程度"
+    elif _FAST_PROBLEM_RE.search(q):
+        intent, complexity = "問題解決", "中程度"
+    elif len(q) <= _LOCAL_ANALYSIS_MAX_CHARS and _FAST_FACT_RE.search(q):
+        intent, complexity = "事実確認", "単純"
+    elif len(q.split()) <= 3 and len(q) <= _TRIVIAL_QUERY_MAX_CHARS:
+        intent, complexity = "情報検索", "単純"
+    else:
+        return None
+
+    analysis = _default_analysis(q)
+    analysis["intent"] = intent
+    analysis["complexity"] = complexity
+    analysis["search_strategy"] = "精密検索" if complexity == "単純" else _INTENT_STRATEGY.get(intent, "包括検索")
+    if _FAST_RECENT_RE.search(q):
+        analysis["time_constraint"] = "最新"
+    return analysis
+
+
+# 完全一致キャッシュのエントリ数上限と有効期間（秒）
+_EXACT_CACHE_SIZE = 512
+_EXACT_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+
+# LLM 呼び出しの同時実行数（全インスタンスで共有）とレート制限/タイムアウト時の再試行
+_LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+_LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+_LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+
+
+def _is_retryable_llm_error(error: Exception) -> bool:
+    """レート制限（429）やタイムアウトなど、再試行で回復し得るエラーかどうか"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    message = f"{type(error).__name__} {error}".lower()
+    return any(marker in message for marker in ("429", "resourceexhausted", "rate limit", "quota", "timeout", "deadline"))
+
+
+# プロバイダごとのJSONモード（出力をJSONに制約する）の指定
+_JSON_MODE_KWARGS = {
+    "ChatGoogleGenerativeAI": {"generation_config": {"response_mime_type": "application/json"}},
+    "ChatOpenAI": {"response_format": {"type": "json_object"}},
+    "AzureChatOpenAI": {"response_format": {"type": "json_object"}},
+    "ChatOllama": {"format": "json"},
+}
+
+
+def _bind_json_mode(llm, enabled: Optional[bool] = None):
+    """JSONのみを出力するよう制約したLLMを返す（未対応のLLMはそのまま返す）
+
+    enabled が None の場合は環境変数 LLM_JSON_MODE とLLMのクラス名から自動判定する。
+    """
+    if enabled is None:
+        enabled = os.getenv("LLM_JSON_MODE", "true").lower() == "true"
+    if not enabled:
+        return llm
+
+    kwargs = _JSON_MODE_KWARGS.get(type(llm).__name__)
+    if kwargs is None or not hasattr(llm, "bind"):
+        logger.debug(f"JSON mode is not available for {type(llm).__name__}, using plain output")
+        return llm
+
+    try:
+        return llm.bind(**kwargs)
+    except Exception as e:
+        logger.warning(f"Failed to enable JSON mode for {type(llm).__name__}: {e}")
+        return llm
+
+
+# 先行キーワード生成の前提とする分析項目（これらが既定値と異なれば生成し直す）
+_SPECULATIVE_KEYS = ("search_strategy", "domain")
+
+
+def _default_analysis(user_query: str) -> Dict[str, Any]:
+    """クエリ分析の既定値（分析失敗時や先行キーワード生成に使用）"""
+    return {
+        "intent": "情報検索",
+        "complexity": "中程度",
+        "time_constraint": "なし",
+        "required_sources": ["google_drive", "chrome_history"],
+        "search_scope": "中程度",
+        "domain": "一般",
+        "key_concepts": [user_query],
+        "search_strategy": "包括検索"
+    }
+
+
 class LLMQueryGenerator:
-    def __init__(self, llm):
+    # 全インスタンスで共有する LLM 呼び出しのセマフォ（イベントループ上で初回使用時に生成）
+    _llm_semaphore: Optional[asyncio.Semaphore] = None
+
+    def __init__(self, llm, embeddings=None, supports_json_mode: Optional[bool] = None):
         self.llm = llm
-        self.search_history = []  # For learning successful patterns
+        # LangChain のチャットモデルはネイティブの非同期APIを使い、スレッドプールを消費しない
+        if hasattr(llm, "ainvoke"):
+            self._ainvoke = llm.ainvoke
+        else:
+            self._ainvoke = lambda prompt: asyncio.to_thread(llm.invoke, prompt)
+        # JSONを返すプロンプト用に、JSONモードで制約したLLM（解析失敗による再試行を防ぐ）
+        # supports_json_mode=None の場合はLLMのクラスから自動判定する
+        self._json_llm = _bind_json_mode(llm, supports_json_mode) if llm else llm
+        self.supports_json_mode = self._json_llm is not llm
+        self.search_history = deque(maxlen=100)  # For learning successful patterns（古い履歴は自動的に破棄）
+        # 実行中のLLM処理（同一入力の同時リクエストは1回の呼び出しを共有する）
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        # キーワード生成と並行して先行生成した多角的RAGクエリ（クエリ -> タスク）
+        self._prefetched_queries: "OrderedDict[Tuple[str, bool], asyncio.Task]" = OrderedDict()
+        self._max_prefetched = 32
+        # ローカル分類用のラベル説明文の埋め込み（初回使用時に計算）
+        self._label_matrices: Dict[Tuple[str, ...], np.ndarray] = {}
+        # 言い換えクエリに対して LLM 呼び出しを省略するためのセマンティックキャッシュ
+        self.semantic_cache = SemanticCache(embeddings) if embeddings is not None else None
+        # 完全一致のクエリ用の LRU キャッシュ（セマンティックキャッシュの前段）
+        self._exact_cache: "OrderedDict[bytes, Tuple[float, Any]]" = OrderedDict()
+    
+    async def _singleflight(self, key: Tuple, factory) -> Any:
+        """同じキーの処理が実行中であれば、新たに実行せずその結果を待つ（キーには no_cache を含める）"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            # 呼び出し元がキャンセルされても、待機中の他の呼び出し元のために処理は継続する
+            return await asyncio.shield(task)
+
+        logger.info(f"Joining in-flight LLM call: {key[0]}")
+        return copy.deepcopy(await asyncio.shield(task))
+    
+    @staticmethod
+    def _exact_cache_key(namespace: str, user_query: str) -> bytes:
+        return hashlib.blake2b(f"{namespace}|{user_query}".encode("utf-8"), digest_size=16).digest()
+    
+    async def _cache_lookup(self, namespace: str, user_query: str, no_cache: bool = False) -> Tuple[Any, Optional[Any]]:
+        """キャッシュを検索し、(埋め込み, キャッシュ済み結果) を返す
+
+        1段目は完全一致の LRU（埋め込み計算不要）、2段目はセマンティックキャッシュ。
+        no_cache=True の場合はキャッシュを参照しない（埋め込みはローカル分類用に計算する）。
+        """
+        if not no_cache:
+            key = self._exact_cache_key(namespace, user_query)
+            entry = self._exact_cache.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if time.time() - stored_at < _EXACT_CACHE_TTL_SECONDS:
+                    self._exact_cache.move_to_end(key)
+                    logger.info(f"Exact cache hit [{namespace}]")
+                    return None, copy.deepcopy(value)
+                del self._exact_cache[key]
+        
+        if not self.semantic_cache:
+            return None, None
+        emb = await self.semantic_cache.embed(user_query)
+        if no_cache:
+            return emb, None
+        return emb, self.semantic_cache.lookup(namespace, emb)
+    
+    def _cache_store(self, namespace: str, user_query: str, emb: Any, value: Any, no_cache: bool = False):
+        """LLM の結果を両方のキャッシュに保存（no_cache=True の場合は保存しない）"""
+        if no_cache:
+            return
+        
+        key = self._exact_cache_key(namespace, user_query)
+        self._exact_cache[key] = (time.time(), copy.deepcopy(value))
+        self._exact_cache.move_to_end(key)
+        while len(self._exact_cache) > _EXACT_CACHE_SIZE:
+            self._exact_cache.popitem(last=False)
         
-    async def analyze_query_intent(self, user_query: str) -> Dict[str, Any]:
+        if self.semantic_cache:
+            self.semantic_cache.store(namespace, emb, value)
+    
+    def clear_cache(self):
+        """完全一致・セマンティックの両キャッシュを破棄"""
+        self._exact_cache.clear()
+        if self.semantic_cache:
+            self.semantic_cache.clear()
+    
+    async def analyze_query_intent(self, user_query: str, no_cache: bool = False) -> Dict[str, Any]:
         """AGR Step 1: ユーザークエリの意図と複雑度を分析"""
+        return await self._singleflight(
+            ("analysis", user_query, no_cache),
+            lambda: self._analyze_query_intent(user_query, no_cache)
+        )
+
+    async def _analyze_query_intent(self, user_query: str, no_cache: bool = False) -> Dict[str, Any]:
         
         if not self.llm:
             logger.error("LLM not available for query analysis")
             return {"intent": "unknown", "complexity": "medium", "sources": ["google_drive"]}
         
+        analysis = _fast_intent_classify(user_query)
+        if analysis is not None:
+            logger.info(f"Query analysis (rules): {analysis['intent']} / {analysis['complexity']} / {analysis['search_strategy']}")
+            return analysis
+        
         try:
-            analysis_prompt = PromptTemplate(
-                template="""あなたは検索クエリ分析の専門家です。以下のユーザークエリを詳細に分析してください。
-
-                # ユーザークエリ
-                "{query}"
-
-                以下の観点で分析し、JSON形式で出力してください：
-
-                厳密にJSON形式のみ出力：
-                {{
-                    "intent": "情報検索|問題解決|比較分析|事実確認|探索的検索",
-                    "complexity": "単純|中程度|複雑",
-                    "time_constraint": "最新|期間指定|時系列|なし",
-                    "required_sources": ["google_drive", "chrome_history", "web_content"],
-                    "search_scope": "狭い|中程度|広い",
-                    "domain": "技術|ビジネス|学術|一般|専門分野",
-                    "key_concepts": ["概念1", "概念2"],
-                    "search_strategy": "精密検索|探索検索|包括検索"
-                }}""",
-                input_variables=["query"]
-            )
+            emb, cached = await self._cache_lookup("analysis", user_query, no_cache)
+            if cached is not None:
+                return cached
             
-            response = await asyncio.to_thread(
-                lambda: self.llm.invoke(analysis_prompt.format(query=user_query))
-            )
+            analysis = await self._classify_query_locally(user_query, emb)
+            if analysis is not None:
+                self._cache_store("analysis", user_query, emb, analysis, no_cache)
+                return analysis
             
-            content = self._parse_json_response(response.content)
-            analysis = self._robust_json_parse(content)
+            analysis = await self._astream_json([
+                _ANALYSIS_SYSTEM,
+                HumanMessage(content=_ANALYSIS_PROMPT.format_map({"query": user_query}))
+            ])
             if analysis is None:
                 raise Exception("Failed to parse query analysis JSON")
             
+            self._cache_store("analysis", user_query, emb, analysis, no_cache)
             logger.info(f"Query analysis: {analysis.get('intent')} / {analysis.get('complexity')} / {analysis.get('search_strategy')}")
             return analysis
             
         except Exception as e:
             logger.error(f"Error in query analysis: {e}")
             # デフォルト分析結果を返す
-            return {
-                "intent": "情報検索",
-                "complexity": "中程度",
-                "time_constraint": "なし",
-                "required_sources": ["google_drive", "chrome_history"],
-                "search_scope": "中程度",
-                "domain": "一般",
-                "key_concepts": [user_query],
-                "search_strategy": "包括検索"
-            }
+            return _default_analysis(user_query)
+
+    async def _label_matrix(self, labels: Dict[str, str]) -> Optional[np.ndarray]:
+        """ラベル説明文の正規化済み埋め込み行列を取得"""
+        key = tuple(labels)
+        matrix = self._label_matrices.get(key)
+        if matrix is None:
+            embs = await asyncio.gather(*(self.semantic_cache.embed(text) for text in labels.values()))
+            if any(e is None for e in embs):
+                return None
+            matrix = np.vstack(embs)
+            self._label_matrices[key] = matrix
+        return matrix
+
+    async def _classify_query_locally(self, user_query: str, emb: Any) -> Optional[Dict[str, Any]]:
+        """短いクエリをラベル埋め込みとの類似度で分類（判定できなければ None）"""
+        if emb is None or not self.semantic_cache or not _is_locally_classifiable(user_query):
+            return None
+
+        intent_matrix, domain_matrix = await asyncio.gather(
+            self._label_matrix(_INTENT_LABELS),
+            self._label_matrix(_DOMAIN_LABELS)
+        )
+        if intent_matrix is None or domain_matrix is None:
+            return None
 
-    async def generate_hierarchical_keywords(self, user_query: str, analysis: Dict[str, Any]) -> Dict[str, Any]:
+        intent = _pick_label(_INTENT_LABELS, intent_matrix, emb)
+        if intent is None:
+            return None
+
+        analysis = _default_analysis(user_query)
+        analysis["intent"] = intent
+        analysis["domain"] = _pick_label(_DOMAIN_LABELS, domain_matrix, emb) or "一般"
+        analysis["complexity"] = "単純" if len(user_query.strip()) <= _TRIVIAL_QUERY_MAX_CHARS else "中程度"
+        analysis["search_strategy"] = _INTENT_STRATEGY.get(intent, "包括検索")
+
+        logger.info(f"Query analysis (local): {analysis['intent']} / {analysis['complexity']} / {analysis['search_strategy']}")
+        return analysis
+
+    async def generate_hierarchical_keywords(self, user_query: str, analysis: Dict[str, Any], no_cache: bool = False) -> Dict[str, Any]:
         """AGR Step 2: 分析結果に基づく階層的キーワード生成"""
+        key = (
+            "keywords", user_query, no_cache,
+            analysis.get('intent'), analysis.get('complexity'),
+            analysis.get('domain'), analysis.get('search_strategy'),
+            tuple(map(str, analysis.get('key_concepts') or ()))
+        )
+        return await self._singleflight(key, lambda: self._generate_hierarchical_keywords(user_query, analysis, no_cache))
+
+    async def _generate_hierarchical_keywords(self, user_query: str, analysis: Dict[str, Any], no_cache: bool = False) -> Dict[str, Any]:
         
         if not self.llm:
             logger.error("LLM not available for keyword generation")
@@ -86,59 +663,44 @@ class LLMQueryGenerator:
             complexity = analysis.get('complexity', '中程度')
             domain = analysis.get('domain', '一般')
             
-            keyword_prompt = PromptTemplate(
-                template="""あなたは高度な検索キーワード戦略の専門家です。以下の分析結果に基づいて、階層的なキーワード戦略を生成してください。
-
-                # 元のクエリ
-                "{query}"
-
-                # 分析結果
-                検索意図: {intent}
-                複雑度: {complexity}
-                ドメイン: {domain}
-                検索戦略: {strategy}
-                主要概念: {concepts}
-
-                以下の階層でキーワードを生成してください：
-                1. 必須キーワード (primary_keywords): AND検索で使用、最も重要な2-4個
-                2. 関連キーワード (secondary_keywords): OR検索で使用、関連概念や同義語5-8個
-                3. 文脈キーワード (context_keywords): 文脈理解を助ける補完キーワード3-5個
-                4. 除外キーワード (negative_keywords): 無関係な結果を除外する1-3個
-
-                各キーワードは検索効率を考慮し、フレーズは2-3語以内に抑えてください。
-
-                厳密にJSON形式のみ出力：
-                {{
-                    "primary_keywords": ["必須キーワード1", "必須キーワード2"],
-                    "secondary_keywords": ["関連キーワード1", "関連キーワード2"],
-                    "context_keywords": ["文脈キーワード1", "文脈キーワード2"],
-                    "negative_keywords": ["除外キーワード1"],
-                    "search_confidence": 0.8,
-                    "strategy_used": "戦略名"
-                }}""",
-                input_variables=["query", "intent", "complexity", "domain", "strategy", "concepts"]
-            )
+            # キーワードは分析結果にも依存するため、分析の主要項目を名前空間に含める
+            cache_namespace = f"keywords:{analysis.get('intent', '情報検索')}|{complexity}|{domain}|{strategy}"
+            emb, cached = await self._cache_lookup(cache_namespace, user_query, no_cache)
+            if cached is not None:
+                return cached
             
-            response = await asyncio.to_thread(
-                lambda: self.llm.invoke(keyword_prompt.format(
-                    query=user_query,
-                    intent=analysis.get('intent', '情報検索'),
-                    complexity=complexity,
-                    domain=domain,
-                    strategy=strategy,
-                    concepts=', '.join(analysis.get('key_concepts', [user_query]))
-                ))
-            )
+            tier_strategy = strategy if strategy in _KEYWORD_TIER_GUIDANCE else '包括検索'
+            human_message = HumanMessage(content=_KEYWORD_PROMPT.format_map({
+                "query": user_query,
+                "intent": analysis.get('intent', '情報検索'),
+                "complexity": complexity,
+                "domain": domain,
+                "strategy": strategy,
+                "concepts": ', '.join(analysis.get('key_concepts', [user_query]))
+            }))
             
-            content = self._parse_json_response(response.content)
-            logger.info(f"LLM response for hierarchical keywords: {content[:200]}...")
+            # 階層ごとの小さなプロンプトを並行実行し、結果を1つの辞書に統合
+            tiers = tuple(_KEYWORD_TIER_LABELS)
+            tier_results = await asyncio.gather(
+                *(self._astream_json([_KEYWORD_TIER_SYSTEMS[(tier_strategy, tier)], human_message]) for tier in tiers),
+                return_exceptions=True
+            )
+            tier_results = dict(zip(tiers, tier_results))
             
-            # 複数の解析方法を試行
-            result = self._robust_json_parse(content)
-            if result is None:
+            primary = tier_results["primary_keywords"]
+            if not isinstance(primary, dict):
                 logger.warning("JSON parsing failed, falling back to alternative methods")
                 raise Exception("All JSON parsing methods failed")
             
+            result = {}
+            for tier, tier_result in tier_results.items():
+                if not isinstance(tier_result, dict):
+                    logger.warning(f"Keyword tier generation failed: {tier}")
+                    tier_result = {}
+                result[tier] = tier_result.get(tier, [])
+            result["search_confidence"] = primary.get("search_confidence", 0.8)
+            result["strategy_used"] = strategy
+            
             # キーワード統計をログ出力
             total_keywords = (len(result.get('primary_keywords', [])) + 
                             len(result.get('secondary_keywords', [])) + 
@@ -148,35 +710,54 @@ class LLMQueryGenerator:
             logger.info(f"  Primary: {len(result.get('primary_keywords', []))}, Secondary: {len(result.get('secondary_keywords', []))}")
             logger.info(f"  Context: {len(result.get('context_keywords', []))}, Negative: {len(result.get('negative_keywords', []))}")
             
+            self._cache_store(cache_namespace, user_query, emb, result, no_cache)
             return result
             
         except Exception as e:
             logger.error(f"Error in hierarchical keyword generation: {e}")
             raise RuntimeError(f"階層的キーワード生成に失敗しました: {str(e)}")
 
-    async def generate_diverse_keywords(self, user_query: str) -> Dict[str, Any]:
+    async def generate_diverse_keywords(self, user_query: str, no_cache: bool = False) -> Dict[str, Any]:
         """AGRフレームワークを使用した高度なキーワード生成"""
         
         try:
-            # Step 1: クエリ分析
-            analysis = await self.analyze_query_intent(user_query)
-            
-            # Step 2: 階層的キーワード生成
-            hierarchical_keywords = await self.generate_hierarchical_keywords(user_query, analysis)
-            
-            # Step 3: 改善のための結果統合
-            all_keywords = []
-            all_keywords.extend(hierarchical_keywords.get('primary_keywords', []))
-            all_keywords.extend(hierarchical_keywords.get('secondary_keywords', []))
-            all_keywords.extend(hierarchical_keywords.get('context_keywords', []))
-            
-            # 重複除去
-            unique_keywords = []
-            seen = set()
-            for keyword in all_keywords:
-                if keyword.lower() not in seen:
-                    unique_keywords.append(keyword)
-                    seen.add(keyword.lower())
+            # Step 3 の多角的RAGクエリはクエリのみに依存するため、キーワード生成と並行して先行生成しておく
+            self._prefetch_multi_perspective_queries(user_query, no_cache)
+            
+            # ルールで分類できるクエリは分析結果が即座に確定するため、投機的な生成は行わない
+            fast_analysis = _fast_intent_classify(user_query) if self.llm else None
+            if fast_analysis is not None:
+                logger.info(f"Query analysis (rules): {fast_analysis['intent']} / {fast_analysis['complexity']} / {fast_analysis['search_strategy']}")
+                analysis = fast_analysis
+                hierarchical_keywords = await self.generate_hierarchical_keywords(user_query, analysis, no_cache)
+            else:
+                # Step 1 & 2: クエリ分析と、既定の分析結果を前提にした階層的キーワード生成を並行実行
+                default_analysis = _default_analysis(user_query)
+                analysis, speculative_keywords = await asyncio.gather(
+                    self.analyze_query_intent(user_query, no_cache),
+                    self.generate_hierarchical_keywords(user_query, default_analysis, no_cache),
+                    return_exceptions=True
+                )
+                if isinstance(analysis, BaseException):
+                    raise analysis
+                
+                # 検索戦略・ドメインが既定値と異なる場合（または先行生成が失敗した場合）は分析結果で生成し直す
+                if (isinstance(speculative_keywords, BaseException) or
+                        any(analysis.get(key) != default_analysis[key] for key in _SPECULATIVE_KEYS)):
+                    logger.info("Speculative keywords discarded, regenerating with query analysis")
+                    hierarchical_keywords = await self.generate_hierarchical_keywords(user_query, analysis, no_cache)
+                else:
+                    hierarchical_keywords = speculative_keywords
+            
+            # Step 3: 改善のための結果統合と重複除去（小文字化は1キーワードにつき1回、最初の出現を保持）
+            seen = {}
+            for keyword in chain(
+                hierarchical_keywords.get('primary_keywords', []),
+                hierarchical_keywords.get('secondary_keywords', []),
+                hierarchical_keywords.get('context_keywords', [])
+            ):
+                seen.setdefault(keyword.casefold(), keyword)
+            unique_keywords = list(seen.values())
             
             result = {
                 'all_keywords': unique_keywords[:20],  # 最大20個に制限
@@ -191,8 +772,38 @@ class LLMQueryGenerator:
             logger.error(f"Error in AGR keyword generation: {e}")
             raise RuntimeError(f"AGRキーワード生成に失敗しました: {str(e)}")
     
-    async def generate_multi_perspective_queries(self, original_query: str, initial_results: Optional[List] = None) -> List[str]:
+    async def generate_multi_perspective_queries(self, original_query: str, initial_results: Optional[List] = None, no_cache: bool = False) -> List[str]:
         """AGR Step 3: 多角的なRAG検索クエリを生成（初回結果による改善を含む）"""
+        if not initial_results:
+            prefetched = self._prefetched_queries.pop((original_query, no_cache), None)
+            if prefetched is not None:
+                logger.info("Using prefetched multi-perspective queries")
+                return await asyncio.shield(prefetched)
+        
+        key = ("multi_perspective", original_query, no_cache, _results_fingerprint(initial_results) if initial_results else None)
+        return await self._singleflight(
+            key,
+            lambda: self._generate_multi_perspective_queries(original_query, initial_results, no_cache)
+        )
+
+    def _prefetch_multi_perspective_queries(self, original_query: str, no_cache: bool = False):
+        """多角的RAGクエリの生成をバックグラウンドで開始"""
+        prefetch_key = (original_query, no_cache)
+        if not self.llm or prefetch_key in self._prefetched_queries:
+            return
+        
+        # 公開メソッドを経由すると自身の先行生成タスクを待ってしまうため、生成処理を直接実行する
+        task = asyncio.ensure_future(self._singleflight(
+            ("multi_perspective", original_query, no_cache, None),
+            lambda: self._generate_multi_perspective_queries(original_query, None, no_cache)
+        ))
+        # 使われずに破棄された場合も例外が未取得の警告にならないようにする
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._prefetched_queries[prefetch_key] = task
+        while len(self._prefetched_queries) > self._max_prefetched:
+            self._prefetched_queries.popitem(last=False)
+
+    async def _generate_multi_perspective_queries(self, original_query: str, initial_results: Optional[List] = None, no_cache: bool = False) -> List[str]:
         
         if not self.llm:
             logger.error("LLM not available for RAG query generation")
@@ -201,56 +812,43 @@ class LLMQueryGenerator:
         try:
             # 初回検索結果がある場合は改善プロンプトを使用
             if initial_results and len(initial_results) > 0:
-                return await self._refine_queries_with_results(original_query, initial_results)
+                return await self._refine_queries_with_results(original_query, initial_results, no_cache)
             
-            rag_prompt = PromptTemplate(
-                template="""あなたはRAG検索の専門家です。以下のユーザークエリに対して、多角的で効果的な検索クエリを生成してください。
-                ただし，検索クエリがgoogle検索のようにならないように気を付けてください．例えば「応用例」という言葉は，広い言葉で便利に感じますが，ドキュメント内で実際に「応用例」という言葉を使っているものは少ないです．
-                この場合，考えられる応用例をあなたが考えてクエリに含める方が効果的です．
-
-                # 元のクエリ
-                "{original_question}"
-
-                以下の戦略を組み合わせて、多様で効果的な検索クエリを生成してください：
-                1. クエリ分解: 複雑なクエリを構成要素に分割
-                2. 観点変更: 異なる視点から同じ情報を探索
-                3. 具体化: 抽象的な概念を具体例で検索
-                4. 一般化: 具体的な質問をより広い概念で検索
-                5. 時系列: 時間軸を考慮した検索
-                6. 因果関係: 原因と結果の両面から検索
-
-                厳密にJSON形式で出力：
-                {{
-                    "decomposed_queries": ["分解クエリ1", "分解クエリ2"],
-                    "perspective_queries": ["視点変更クエリ1", "視点変更クエリ2"],
-                    "specific_queries": ["具体化クエリ1", "具体化クエリ2"],
-                    "general_queries": ["一般化クエリ1", "一般化クエリ2"],
-                    "temporal_queries": ["時系列クエリ1"],
-                    "causal_queries": ["因果関係クエリ1"],
-                    "all_queries": ["統合された全クエリリスト"]
-                }}""",
-                input_variables=["original_question"]
-            )
+            # 短いクエリは LLM 呼び出しを省略
+            if _is_trivial_query(original_query):
+                logger.info(f"Trivial query, using template RAG queries: {original_query}")
+                return _fallback_rag_queries(original_query)
             
-            response = await asyncio.to_thread(
-                lambda: self.llm.invoke(rag_prompt.format(
-                    original_question=original_query
-                ))
-            )
+            emb, cached = await self._cache_lookup("multi_perspective", original_query, no_cache)
+            if cached is not None:
+                return cached
             
-            content = self._parse_json_response(response.content)
-            result = self._robust_json_parse(content)
-            if result is None:
+            results = await asyncio.gather(
+                *(self._astream_json(prompt.format_map({"original_question": original_query}))
+                  for prompt in _MULTI_PERSPECTIVE_PROMPTS),
+                return_exceptions=True
+            )
+            results = [result for result in results if isinstance(result, dict)]
+            if not results:
                 raise Exception("Failed to parse multi-perspective queries JSON")
-            all_queries = result.get("all_queries", [])
+            
+            # 各プロンプトの結果を順に統合し、重複を除去
+            seen = {}
+            for result in results:
+                for query in result.get("all_queries", []):
+                    seen.setdefault(query.lower(), query)
+            all_queries = list(seen.values())
             
             # クエリ多様性のログ
-            logger.info(f"Generated multi-perspective queries: {len(all_queries)} total")
-            for strategy, queries in result.items():
-                if strategy != "all_queries" and isinstance(queries, list):
-                    logger.info(f"  {strategy}: {len(queries)} queries")
+            logger.info(f"Generated multi-perspective queries: {len(all_queries)} total ({len(results)}/{len(_MULTI_PERSPECTIVE_PROMPTS)} prompts)")
+            for result in results:
+                for strategy, queries in result.items():
+                    if strategy != "all_queries" and isinstance(queries, list):
+                        logger.info(f"  {strategy}: {len(queries)} queries")
             
-            return all_queries[:15]  # 最大15個
+            all_queries = all_queries[:15]  # 最大15個
+            self._cache_store("multi_perspective", original_query, emb, all_queries, no_cache)
+            return all_queries
             
         except Exception as e:
             logger.error(f"Error in multi-perspective query generation: {e}")
@@ -260,60 +858,34 @@ class LLMQueryGenerator:
         """後方互換性のためのラッパー関数"""
         return await self.generate_multi_perspective_queries(original_query)
     
-    async def _refine_queries_with_results(self, original_query: str, initial_results: List) -> List[str]:
+    async def _refine_queries_with_results(self, original_query: str, initial_results: List, no_cache: bool = False) -> List[str]:
         """初回検索結果を基にクエリを改善 (AGR Refine段階)"""
         
         try:
             # 初回結果の品質分析
             result_analysis = self._analyze_initial_results(initial_results)
             
-            refine_prompt = PromptTemplate(
-                template="""あなたは検索改善の専門家です。初回検索結果を分析し、より効果的なクエリを生成してください。
-
-                # 元のクエリ
-                "{original_query}"
-
-                # 初回検索結果の分析
-                結果数: {result_count}
-                関連性: {relevance_score}
-                カバレッジ: {coverage_analysis}
-                不足している要素: {missing_elements}
-
-                初回結果の課題を踏まえ、以下の改善策を適用したクエリを生成してください：
-                1. 不足要素を補完するクエリ
-                2. より具体的な検索クエリ
-                3. 異なる角度からのアプローチ
-                4. 関連性を高めるためのクエリ
-
-                厳密にJSON形式で出力：
-                {{
-                    "refined_queries": ["改善クエリ1", "改善クエリ2"],
-                    "complementary_queries": ["補完クエリ1", "補完クエリ2"],
-                    "specific_queries": ["具体化クエリ1", "具体化クエリ2"],
-                    "alternative_queries": ["代替クエリ1", "代替クエリ2"],
-                    "all_queries": ["全改善クエリリスト"]
-                }}""",
-                input_variables=["original_query", "result_count", "relevance_score", "coverage_analysis", "missing_elements"]
-            )
-            
-            response = await asyncio.to_thread(
-                lambda: self.llm.invoke(refine_prompt.format(
-                    original_query=original_query,
-                    result_count=len(initial_results),
-                    relevance_score=result_analysis.get('relevance_score', 'unknown'),
-                    coverage_analysis=result_analysis.get('coverage', 'limited'),
-                    missing_elements=', '.join(result_analysis.get('missing_elements', []))
-                ))
-            )
+            # 改善クエリは初回結果に依存するため、結果の識別子も名前空間に含める
+            cache_namespace = f"refine:{_results_fingerprint(initial_results)}"
+            emb, cached = await self._cache_lookup(cache_namespace, original_query, no_cache)
+            if cached is not None:
+                return cached
             
-            content = self._parse_json_response(response.content)
-            result = self._robust_json_parse(content)
+            result = await self._astream_json(_REFINE_PROMPT.format_map({
+                "original_query": original_query,
+                "result_count": len(initial_results),
+                "relevance_score": result_analysis.get('relevance_score', 'unknown'),
+                "coverage_analysis": result_analysis.get('coverage', 'limited'),
+                "missing_elements": ', '.join(result_analysis.get('missing_elements', []))
+            }))
             if result is None:
                 raise Exception("Failed to parse query refinement JSON")
             refined_queries = result.get("all_queries", [])
             
             logger.info(f"Refined {len(refined_queries)} queries based on initial results")
-            return refined_queries[:10]  # 改善クエリは10個まで
+            refined_queries = refined_queries[:10]  # 改善クエリは10個まで
+            self._cache_store(cache_namespace, original_query, emb, refined_queries, no_cache)
+            return refined_queries
             
         except Exception as e:
             logger.error(f"Error in query refinement: {e}")
@@ -329,9 +901,38 @@ class LLMQueryGenerator:
                     'missing_elements': ['no results found']
                 }
             
-            # 簡単な分析ロジック
             result_count = len(results)
             
+            # スコア付きの結果（similarity_score / score）であれば、スコア分布から評価する
+            scores = np.fromiter((_result_score(r) for r in results), dtype=np.float32, count=result_count)
+            scores = scores[~np.isnan(scores)]
+            if scores.size:
+                mean_score = float(scores.mean())
+                p10_score = float(np.quantile(scores, 0.1))
+                coverage_ratio = float((scores > 0.5).mean())
+                
+                relevance = 'good' if mean_score >= 0.7 else 'moderate' if mean_score >= 0.5 else 'poor'
+                coverage = 'comprehensive' if coverage_ratio >= 0.8 else 'partial' if coverage_ratio >= 0.4 else 'limited'
+                missing = []
+                if result_count < 3:
+                    missing.append('insufficient results')
+                if coverage_ratio < 0.4:
+                    missing.append('need broader search')
+                if p10_score < 0.5:
+                    missing.append('low-relevance tail, need more specific terms')
+                if not missing:
+                    missing.append('consider refinement for precision')
+                
+                return {
+                    'relevance_score': f"{relevance} (平均スコア {mean_score:.2f}, 下位10% {p10_score:.2f})",
+                    'coverage': f"{coverage} (スコア0.5超: {coverage_ratio:.0%})",
+                    'missing_elements': missing,
+                    'mean_score': mean_score,
+                    'p10_score': p10_score,
+                    'coverage_ratio': coverage_ratio
+                }
+            
+            # スコアが無い場合は件数による簡易分析
             if result_count < 3:
                 relevance = 'poor'
                 coverage = 'limited'
@@ -359,148 +960,115 @@ class LLMQueryGenerator:
                 'missing_elements': ['analysis failed']
             }
 
+    @classmethod
+    def _get_llm_semaphore(cls) -> asyncio.Semaphore:
+        if cls._llm_semaphore is None:
+            cls._llm_semaphore = asyncio.Semaphore(_LLM_MAX_CONCURRENCY)
+        return cls._llm_semaphore
+
+    async def _call_llm(self, factory) -> Any:
+        """同時実行数を制限して LLM を呼び出し、429/タイムアウト時は指数バックオフで再試行"""
+        for attempt in range(_LLM_MAX_RETRIES + 1):
+            async with self._get_llm_semaphore():
+                try:
+                    return await factory()
+                except Exception as e:
+                    if attempt >= _LLM_MAX_RETRIES or not _is_retryable_llm_error(e):
+                        raise
+                    error = e
+            # 待機中はセマフォを解放し、他のリクエストを妨げない
+            delay = _LLM_RETRY_BASE_DELAY * (2 ** attempt) * (1 + random.random() * 0.5)
+            logger.warning(f"LLM call failed ({error}), retrying in {delay:.1f}s ({attempt + 1}/{_LLM_MAX_RETRIES})")
+            await asyncio.sleep(delay)
+
+    async def _astream_json(self, prompt: Any) -> Optional[Dict[str, Any]]:
+        """LLMの出力をストリーミングで受け取り、JSONが閉じた時点で解析する（同時実行数制限・再試行付き）"""
+        return await self._call_llm(lambda: self._astream_json_once(prompt))
+
+    async def _astream_json_once(self, prompt: Any) -> Optional[Dict[str, Any]]:
+        """LLMの出力をストリーミングで受け取り、JSONが閉じた時点で解析する
+
+        チャンクはリストに溜めて結合は解析時のみ行う。チャンク末尾が } または ]
+        の場合だけ厳密な解析を試み、成功すればストリームの残り（閉じのコード
+        フェンス等）を待たずに返す。最後まで解析できなければ従来の堅牢な解析に回す。
+        """
+        if not hasattr(self._json_llm, "astream"):
+            if hasattr(self._json_llm, "ainvoke"):
+                response = await self._json_llm.ainvoke(prompt)
+            else:
+                response = await self._ainvoke(prompt)
+            if self.supports_json_mode:
+                # JSONモードでは出力がそのまま正しいJSONになるため、前処理なしで解析する
+                try:
+                    return orjson.loads(response.content)
+                except orjson.JSONDecodeError:
+                    pass
+            return self._robust_json_parse(self._parse_json_response(response.content))
+
+        chunks: List[str] = []
+        stream = self._json_llm.astream(prompt)
+        try:
+            async for chunk in stream:
+                text = chunk.content if hasattr(chunk, "content") else str(chunk)
+                if not text:
+                    continue
+                chunks.append(text)
+
+                tail = text.rstrip()[-1:]
+                if tail and tail in "}]":
+                    content = "".join(chunks)
+                    start = content.find("{")
+                    if start < 0:
+                        continue
+                    try:
+                        result = orjson.loads(content[start:])
+                    except orjson.JSONDecodeError:
+                        continue
+                    if isinstance(result, dict):
+                        return result
+        finally:
+            await stream.aclose()
+
+        content = self._parse_json_response("".join(chunks))
+        logger.debug(f"Streamed LLM response required fallback parsing: {content[:200]}...")
+        return self._robust_json_parse(content)
+
     def _parse_json_response(self, content: str) -> str:
-        """JSONレスポンスのパース処理を統一（堅牢化版）"""
-        import re
-        
-        content = content.strip()
-        
-        # マークダウンコードブロックの除去（複数パターン対応）
-        # ```json または ``` で始まる場合
-        if content.startswith("```json"):
-            content = content[7:]
-        elif content.startswith("```"):
-            content = content[3:]
-        
-        # ``` で終わる場合
-        if content.endswith("```"):
-            content = content[:-3]
-        
-        content = content.strip()
-        
-        # JSONオブジェクトの抽出（複数のJSONが含まれる場合の対策）
-        # 最初の { から最後の } までを抽出
-        json_match = re.search(r'\{.*\}', content, re.DOTALL)
-        if json_match:
-            content = json_match.group(0)
-        
-        # LLMが生成する不正な文字列を除去
-        # "Farrago." や類似の不正な文字列を除去
-        content = re.sub(r'\s+[A-Z][a-z]+\.\s*"?\s*\]', ']', content)
-        content = re.sub(r',\s*[A-Z][a-z]+\.\s*"?\s*\]', ']', content)
-        
-        # 配列内の不正な要素を除去
-        content = re.sub(r',\s*"[A-Z][a-z]+\."', '', content)
-        content = re.sub(r'"[A-Z][a-z]+\.",?\s*', '', content)
-        
-        # 末尾のカンマを除去（よくあるJSONエラー）
-        content = re.sub(r',(\s*[}\]])', r'\1', content)
-        
-        # 不正な改行や余分な空白の正規化
-        content = re.sub(r'\s+', ' ', content)
-        content = re.sub(r',\s*}', '}', content)
-        content = re.sub(r',\s*]', ']', content)
-        
-        # 空の配列要素を除去
-        content = re.sub(r'\[\s*,', '[', content)
-        content = re.sub(r',\s*,', ',', content)
-        
-        return content.strip()
+        """JSONレスポンスのパース処理を統一（コードフェンス除去・JSON抽出・正規化を1回の走査で行う）"""
+        return _extract_json_block(content)
 
     def _robust_json_parse(self, content: str) -> Optional[Dict[str, Any]]:
         """堅牢なJSON解析（複数の方法を試行）"""
-        import ast
-        
-        # 方法1: 標準のjson.loads
+        # 方法1: 厳密なJSON解析 (orjson)
         try:
-            return json.loads(content)
-        except json.JSONDecodeError as e:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError as e:
             logger.debug(f"Standard JSON parsing failed: {e}")
         
-        # 方法2: 単一引用符を二重引用符に変換して再試行
+        # 方法2: 不正な文字列（"Farrago." など）を除去して再試行
+        content = _strip_junk_tokens(content)
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError as e:
+            logger.debug(f"Junk-stripped JSON parsing failed: {e}")
+        
+        # 方法3: 単一引用符を二重引用符に変換して再試行
         try:
             # 単一引用符を二重引用符に変換（文字列内の引用符は除く）
             fixed_content = content.replace("'", '"')
-            return json.loads(fixed_content)
-        except json.JSONDecodeError as e:
+            return orjson.loads(fixed_content)
+        except orjson.JSONDecodeError as e:
             logger.debug(f"Quote-fixed JSON parsing failed: {e}")
         
-        # 方法3: eval（セキュリティに注意）- Pythonの辞書形式の場合
-        try:
-            # eval は危険だが、限定的な文字列のみ許可
-            if content.strip().startswith('{') and content.strip().endswith('}'):
-                result = ast.literal_eval(content)
-                if isinstance(result, dict):
-                    return result
-        except (ValueError, SyntaxError) as e:
-            logger.debug(f"AST literal_eval parsing failed: {e}")
-        
-        # 方法4: 正規表現による部分抽出
+        # 方法4: 途中で切れたJSONから、完結している部分だけを取り出す
+        # （閉じ括弧の欠落だけで LLM を再呼び出しするのを避ける）
         try:
-            import re
-            
-            # 各フィールドを個別に抽出
-            result = {}
-            
-            # primary_keywords を抽出
-            primary_match = re.search(r'"primary_keywords":\s*\[(.*?)\]', content, re.DOTALL)
-            if primary_match:
-                keywords_str = primary_match.group(1)
-                keywords = [k.strip(' "\'') for k in keywords_str.split(',') if k.strip()]
-                result['primary_keywords'] = keywords
-            
-            # secondary_keywords を抽出
-            secondary_match = re.search(r'"secondary_keywords":\s*\[(.*?)\]', content, re.DOTALL)
-            if secondary_match:
-                keywords_str = secondary_match.group(1)
-                keywords = [k.strip(' "\'') for k in keywords_str.split(',') if k.strip()]
-                result['secondary_keywords'] = keywords
-            
-            # context_keywords を抽出
-            context_match = re.search(r'"context_keywords":\s*\[(.*?)\]', content, re.DOTALL)
-            if context_match:
-                keywords_str = context_match.group(1)
-                keywords = [k.strip(' "\'') for k in keywords_str.split(',') if k.strip()]
-                result['context_keywords'] = keywords
-            
-            # negative_keywords を抽出
-            negative_match = re.search(r'"negative_keywords":\s*\[(.*?)\]', content, re.DOTALL)
-            if negative_match:
-                keywords_str = negative_match.group(1)
-                keywords = [k.strip(' "\'') for k in keywords_str.split(',') if k.strip()]
-                result['negative_keywords'] = keywords
-            
-            # RAGクエリ関連フィールドを抽出
-            # decomposed_queries を抽出
-            decomposed_match = re.search(r'"decomposed_queries":\s*\[(.*?)\]', content, re.DOTALL)
-            if decomposed_match:
-                queries_str = decomposed_match.group(1)
-                queries = [q.strip(' "\'') for q in queries_str.split(',') if q.strip() and not q.strip().endswith('.')]
-                result['decomposed_queries'] = queries
-            
-            # all_queries を抽出
-            all_queries_match = re.search(r'"all_queries":\s*\[(.*?)\]', content, re.DOTALL)
-            if all_queries_match:
-                queries_str = all_queries_match.group(1)
-                queries = [q.strip(' "\'') for q in queries_str.split(',') if q.strip() and not q.strip().endswith('.')]
-                result['all_queries'] = queries
-            
-            # search_confidence を抽出
-            confidence_match = re.search(r'"search_confidence":\s*([\d.]+)', content)
-            if confidence_match:
-                result['search_confidence'] = float(confidence_match.group(1))
-            
-            # strategy_used を抽出
-            strategy_match = re.search(r'"strategy_used":\s*"([^"]+)"', content)
-            if strategy_match:
-                result['strategy_used'] = strategy_match.group(1)
-            
-            if result:  # 何らかのフィールドが抽出できた場合
-                logger.info("Successfully parsed JSON using regex fallback")
+            result = from_json(content, allow_partial=True)
+            if isinstance(result, dict) and not _EXPECTED_RESPONSE_KEYS.isdisjoint(result):
+                logger.info("Salvaged truncated JSON using partial parsing")
                 return result
-                
-        except Exception as e:
-            logger.debug(f"Regex parsing failed: {e}")
+        except ValueError as e:
+            logger.debug(f"Partial JSON parsing failed: {e}")
         
         # すべての方法が失敗
         logger.error(f"All JSON parsing methods failed for content: {content[:100]}...")
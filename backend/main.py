@@ -4,20 +4,31 @@ Extend Your Memory Backend API
 FastAPI server with RAG pipeline and MCP integration
 """
 
-import json
+import asyncio
+import hashlib
+import importlib.util
 import logging
 import os
-from typing import List, Dict, Any, Optional
+import time
+from typing import List, Dict, Any, Optional, FrozenSet
 from datetime import datetime
 
-from fastapi import FastAPI, WebSocket, HTTPException
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.websockets import WebSocketState
 from pydantic import BaseModel
 from dotenv import load_dotenv
+import orjson
+import ormsgpack
+import uvicorn
 
 # RAG Pipeline のインポート
 from rag_pipeline import RAGPipeline
-from config_manager import excluded_folders_config
+from config_manager import get_excluded_folders_config
+from semantic_cache import QueryResultCache
 
 load_dotenv()
 
@@ -28,6 +39,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 同時に実行する検索の上限（LLM/MCP への過剰な同時リクエストを防ぐ）
+MAX_CONCURRENT_SEARCHES = int(os.getenv("MAX_CONCURRENT_SEARCHES", "8"))
+SEARCH_SEM = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
+# 実行中の検索数（/metrics で空きスロット数を算出する）
+_searches_in_flight = 0
+
+
+@asynccontextmanager
+async def _search_slot():
+    """検索の実行枠を確保し、実行中の検索数を数える"""
+    global _searches_in_flight
+    async with SEARCH_SEM:
+        _searches_in_flight += 1
+        try:
+            yield
+        finally:
+            _searches_in_flight -= 1
+
+# WebSocketで受け付けるリクエストの最大サイズと、イベントループ上で直接解析するサイズの上限
+MAX_QUERY_BYTES = int(os.getenv("MAX_QUERY_BYTES", str(1024 * 1024)))
+_INLINE_PARSE_MAX_BYTES = 64_000
+
+# 文字化けの原因となる可能性のある制御文字（str.translate で削除する。タブ・改行・復帰は残す）
+_CONTROL_CHARS_TABLE = dict.fromkeys([*range(0x00, 0x09), 0x0b, 0x0c, *range(0x0e, 0x20), *range(0x7f, 0xa0)])
+
+# 検索結果の表示用メタデータ: ソースの表示名と、ソース種別（先頭一致）ごとの参照URLの生成
+_SOURCE_DISPLAY_NAMES = {"web_fetch": "Chrome History"}
+
+def _google_drive_url(metadata: Dict[str, Any]) -> Optional[str]:
+    file_id = metadata.get("file_id") or metadata.get("id")
+    return f"https://drive.google.com/file/d/{file_id}/view" if file_id else None
+
+_SOURCE_URL_BUILDERS = (
+    ("google_drive", _google_drive_url),
+)
+
+# numpy のスカラー・配列（類似度スコアなど）も orjson が C 実装で直接シリアライズする
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def _json_default(obj: Any) -> Any:
+    """orjson が直接扱えない値（メタデータ中の集合など）の変換"""
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+# WebSocket で選択できる応答形式
+_WIRE_FORMATS = frozenset({"json", "msgpack"})
+
+async def _send(websocket: WebSocket, payload: Dict[str, Any]):
+    """orjson でシリアライズして送信（フロントエンドは JSON.parse するためテキストフレームで送る）
+
+    fmt=msgpack を指定して接続したクライアントには MessagePack のバイナリフレームで送る。
+    """
+    if websocket.query_params.get("fmt") == "msgpack":
+        await websocket.send_bytes(ormsgpack.packb(
+            payload, default=_json_default, option=ormsgpack.OPT_NON_STR_KEYS | ormsgpack.OPT_SERIALIZE_NUMPY
+        ))
+        return
+    await websocket.send_text(orjson.dumps(payload, default=_json_default, option=_ORJSON_OPTIONS).decode())
+
 app = FastAPI(
     title="Extend Your Memory API",
     description="AI-powered search and report generation from Google Drive and browser history",
@@ -48,6 +119,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 大きなレスポンス（/search のレポートやソース一覧）を圧縮して転送量を減らす
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# 進捗イベントの固定部分（段階ごとに details だけを差し込む）
+_PROGRESS_STAGES = {
+    "keyword_generation": {"step": 1, "stage": "keyword_generation", "message": "検索キーワードを生成中..."},
+    "mcp_search": {"step": 2, "stage": "mcp_search", "message": "MCPサーバーでソースを検索中..."},
+    "vectorization": {"step": 4, "stage": "vectorization", "message": "取得したドキュメントをベクトル化中..."},
+    "rag_search": {"step": 5, "stage": "rag_search", "message": "セマンティック検索を実行中..."},
+    "rag_search_complete": {"step": 6, "stage": "rag_search_complete", "message": "セマンティック検索完了"},
+    "report_generation": {"step": 7, "stage": "report_generation", "message": "レポートを生成中..."},
+}
+
 class QueryRequest(BaseModel):
     query: str
     user_id: Optional[str] = None
@@ -62,12 +146,14 @@ class ExcludedFolderRequest(BaseModel):
 class ConfigSettingsRequest(BaseModel):
     settings: Dict[str, Any]
 
+# 進捗イベント data のスキーマ（送信時は _PROGRESS_STAGES から直接組み立てる）
 class SearchProgress(BaseModel):
     step: int
     stage: str
     message: str
     details: Optional[Dict[str, Any]] = None
 
+# サーバー内で組み立てる値のため、生成時は model_construct で検証を省略する
 class SearchResult(BaseModel):
     report: str
     sources: List[Dict[str, Any]]
@@ -78,320 +164,554 @@ class SearchResult(BaseModel):
 
 # RAGパイプラインインスタンス
 rag_pipeline = RAGPipeline()
+# 起動時に接続を確立し、終了時に予約済みのベクトルストア保存を書き出して接続を閉じる
+app.add_event_handler("startup", rag_pipeline.ainit)
+app.add_event_handler("shutdown", rag_pipeline.flush_vector_store)
+app.add_event_handler("shutdown", rag_pipeline.aclose)
+
+# 検索結果キャッシュ（同一・類似クエリではパイプライン全体を省略する）
+search_cache = QueryResultCache(rag_pipeline.embeddings)
+
+# 検索段階（MCP検索・ベクトル化・セマンティック検索）の結果キャッシュ。
+# 短期間の再検索ではレポート生成のみを行う（RETRIEVAL_CACHE_TTL_SECONDS=0 で無効）
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "300"))
+retrieval_cache = QueryResultCache(ttl_seconds=RETRIEVAL_CACHE_TTL_SECONDS)
+
+def resolve_excluded_folder_ids(request_ids: Optional[List[str]] = None) -> FrozenSet[str]:
+    """検索で除外するフォルダIDを決定（リクエストで指定がない場合は設定ファイルから自動読み込み）"""
+    if request_ids is not None:
+        return frozenset(request_ids)
+    if get_excluded_folders_config().is_auto_exclude_enabled():
+        excluded_folder_ids = get_excluded_folders_config().get_excluded_folder_ids_set()
+        logger.info(f"Auto-loaded {len(excluded_folder_ids)} excluded folders from config")
+        return excluded_folder_ids
+    return frozenset()
+
+def _search_cache_scope(excluded_folder_ids: FrozenSet[str]) -> str:
+    """除外フォルダの組み合わせと設定のバージョンごとにキャッシュを分けるためのスコープ
+
+    設定のバージョンを含めることで、除外フォルダ・しきい値などの変更後に古い検索結果を使わない。
+    """
+    folders_key = ""
+    if excluded_folder_ids:
+        folders_key = hashlib.blake2b("\0".join(sorted(excluded_folder_ids)).encode("utf-8"), digest_size=8).hexdigest()
+    return f"{folders_key}:v{get_excluded_folders_config().version}"
+
+def _retrieval_cache_entry(keywords: List[str], rag_queries: List[str], sources: List[Dict[str, Any]],
+                           document_count: int, relevant_docs: List[Any]) -> Dict[str, Any]:
+    """検索段階の結果をキャッシュ用の辞書にまとめる"""
+    return {
+        "keywords": keywords,
+        "rag_queries": rag_queries,
+        "sources": sources,
+        "document_count": document_count,
+        "relevant_docs": relevant_docs
+    }
+
+async def _get_cached_search(query: str, cache_scope: str) -> Optional[Dict[str, Any]]:
+    """検索結果キャッシュを参照（無効化されている場合は常に None）"""
+    if not get_excluded_folders_config().is_search_cache_enabled():
+        return None
+    return await search_cache.get(query, cache_scope)
+
+def _search_cache_entry(result: SearchResult, rag_results: List[Dict[str, Any]], similarity_threshold: float) -> Dict[str, Any]:
+    """検索結果と、キャッシュヒット時に再送する RAG 検索結果をまとめる"""
+    return {
+        "result": result.model_dump(),
+        "rag_results": rag_results,
+        "similarity_threshold": similarity_threshold
+    }
+
+def _build_rag_results(relevant_docs: List[Any]) -> List[Dict[str, Any]]:
+    """rag_search_complete で送信する表示用の検索結果（最初の10件）を組み立てる"""
+    rag_results_data = []
+    for doc in relevant_docs[:10]:  # 最初の10件を送信
+        metadata = getattr(doc, 'metadata', {}).copy()
+        # スコアをメタデータから取得
+        score = metadata.get('similarity_score', getattr(doc, 'score', None))
+        
+        # 表示名の置き換え（web_fetch -> Chrome History）と、ソース種別ごとのURL生成
+        source = metadata.get('source') or ''
+        display_name = _SOURCE_DISPLAY_NAMES.get(source)
+        if display_name:
+            metadata['source'] = display_name
+        for prefix, build_url in _SOURCE_URL_BUILDERS:
+            if source.startswith(prefix):
+                url = build_url(metadata)
+                if url:
+                    metadata['url'] = url
+                break
+        
+        # 日本語の文字化けを防ぐため、UTF-8エンコーディングを確実にする
+        content = doc.page_content[:500] if hasattr(doc, 'page_content') else str(doc)[:500]
+        
+        # 文字化けの原因となる可能性のある制御文字を除去
+        content = content.translate(_CONTROL_CHARS_TABLE)
+        
+        rag_results_data.append({
+            "content": content,
+            "metadata": metadata,
+            "score": score
+        })
+    return rag_results_data
+
+async def _send_cached_stages(websocket: WebSocket, query: str, keywords: List[str], document_count: int, rag_queries: List[str]):
+    """キャッシュから復元した検索段階を、UIの進捗表示を揃えるため cached として通知"""
+    for stage, details in (
+        ("keyword_generation", {"query": query}),
+        ("mcp_search", {"keywords": keywords}),
+        ("vectorization", {"total_documents": document_count}),
+        ("rag_search", {"rag_queries": rag_queries}),
+    ):
+        await _send(websocket, {
+            "event": "search_progress",
+            "data": {
+                **_PROGRESS_STAGES[stage],
+                "details": {**details, "cached": True}
+            }
+        })
+
+async def _send_rag_search_complete(websocket: WebSocket, rag_queries: List[str], rag_results: List[Dict[str, Any]],
+                                    total_results: int, similarity_threshold: float, cached: bool = False):
+    """RAG検索結果を進行状況として送信（フロントエンドはこの結果をRAGパネルと履歴に保存する）"""
+    details = {
+        "rag_queries": rag_queries,
+        "results": rag_results,
+        "total_results": total_results,
+        "similarity_threshold": similarity_threshold
+    }
+    if cached:
+        details["cached"] = True
+    await _send(websocket, {
+        "event": "search_progress",
+        "data": {
+            **_PROGRESS_STAGES["rag_search_complete"],
+            "message": f"セマンティック検索完了: {total_results}件の関連ドキュメントを発見",
+            "details": details
+        }
+    })
+
+async def _replay_cached_search(websocket: WebSocket, query: str, cached: Dict[str, Any]) -> SearchResult:
+    """検索結果キャッシュのヒット時に、通常の検索と同じ進捗イベントを再送して結果を返す"""
+    result = cached["result"]
+    await _send_cached_stages(websocket, query, result["keywords_used"], result["total_documents"], result["rag_queries"])
+    await _send_rag_search_complete(
+        websocket, result["rag_queries"], cached["rag_results"],
+        result["relevant_documents"], cached["similarity_threshold"], cached=True
+    )
+    await _send(websocket, {
+        "event": "search_progress",
+        "data": {
+            **_PROGRESS_STAGES["report_generation"],
+            "details": {
+                "relevant_sources": result["relevant_documents"],
+                "citations_count": result["relevant_documents"],
+                "cached": True
+            }
+        }
+    })
+    return SearchResult.model_construct(**result)
 
 @app.get("/")
 async def root():
     return {"message": "Extend Your Memory API", "status": "running"}
 
+# ヘルスチェック用のタイムスタンプ（ISO形式の文字列, 生成時の monotonic 時刻）- 1秒間は使い回す
+_health_timestamp = ("", float("-inf"))
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    global _health_timestamp
+    now = time.monotonic()
+    if now - _health_timestamp[1] >= 1.0:
+        _health_timestamp = (datetime.now().isoformat(), now)
+    return {
+        "status": "healthy",
+        "timestamp": _health_timestamp[0],
+        # uvloop が有効なら "uvloop"、標準ループなら "asyncio"
+        "event_loop": type(asyncio.get_running_loop()).__module__.split(".")[0],
+        "search_cache": search_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """同時実行数の調整用の指標"""
+    return {
+        "max_concurrent_searches": MAX_CONCURRENT_SEARCHES,
+        "available_search_slots": MAX_CONCURRENT_SEARCHES - _searches_in_flight
+    }
 
 @app.websocket("/ws/search")
 async def websocket_search(websocket: WebSocket):
-    """リアルタイム検索進捗のWebSocket接続"""
+    """リアルタイム検索進捗のWebSocket接続（?fmt=msgpack で MessagePack のバイナリフレーム）"""
     await websocket.accept()
+    wire_format = websocket.query_params.get("fmt", "json")
+    if wire_format not in _WIRE_FORMATS:
+        # 未対応の形式を黙って JSON に切り替えると、クライアントが応答を解読できないため切断する
+        await websocket.close(code=1003, reason=f"Unsupported fmt: {wire_format}")
+        return
     
     try:
         while True:
             data = await websocket.receive_text()
-            request = json.loads(data)
+            if len(data) > MAX_QUERY_BYTES:
+                await _send(websocket, {
+                    "error": "Request is too large"
+                })
+                continue
+            # 大きなリクエストは他の接続を止めないようスレッドで解析する
+            if len(data) < _INLINE_PARSE_MAX_BYTES:
+                request = orjson.loads(data)
+            else:
+                request = await asyncio.to_thread(orjson.loads, data)
             query = request.get("query", "")
-            excluded_folder_ids = request.get("excluded_folder_ids")
+            excluded_folder_ids = resolve_excluded_folder_ids(request.get("excluded_folder_ids"))
+            # レポートを report_token イベントで逐次受け取るかどうか（対応するクライアントのみ指定する）
+            stream_report = bool(request.get("stream_report", False))
             
             if not query:
-                await websocket.send_text(json.dumps({
+                await _send(websocket, {
                     "error": "Query is required"
-                }))
+                })
                 continue
             
-            # 設定ファイルから除外フォルダを自動読み込み（リクエストで指定がない場合）
-            if excluded_folder_ids is None and excluded_folders_config.is_auto_exclude_enabled():
-                excluded_folder_ids = excluded_folders_config.get_excluded_folder_ids()
-                logger.info(f"Auto-loaded {len(excluded_folder_ids)} excluded folders from config")
-            
-            # 検索プロセスの実行
-            result = await process_search_with_progress(query, websocket, excluded_folder_ids)
+            # キャッシュヒットは実行中の検索を待たずに返す
+            cached = await _get_cached_search(query, _search_cache_scope(excluded_folder_ids))
+            if cached is not None:
+                result = await _replay_cached_search(websocket, query, cached)
+            else:
+                # 検索プロセスの実行（上限に達している場合は待機中であることを通知）
+                if SEARCH_SEM.locked():
+                    await _send(websocket, {
+                        "event": "queued",
+                        "message": "他の検索が完了するまで待機中..."
+                    })
+                async with _search_slot():
+                    result = await process_search_with_progress(query, websocket, excluded_folder_ids, stream_report)
             
             # 最終結果の送信
-            await websocket.send_text(json.dumps({
+            await _send(websocket, {
                 "event": "search_complete",
-                "data": result.dict()
-            }, ensure_ascii=False))
+                "data": result.model_dump()
+            })
             
+    except WebSocketDisconnect:
+        logger.info("WebSocket client disconnected")
     except Exception as e:
-        await websocket.send_text(json.dumps({
+        await _send(websocket, {
             "event": "error",
             "message": str(e)
-        }, ensure_ascii=False))
+        })
 
-async def process_search_with_progress(query: str, websocket: WebSocket, excluded_folder_ids: Optional[List[str]] = None) -> SearchResult:
-    """進捗をWebSocketで送信しながら検索を実行"""
+async def process_search_with_progress(query: str, websocket: WebSocket, excluded_folder_ids: FrozenSet[str] = frozenset(),
+                                       stream_report: bool = False) -> SearchResult:
+    """進捗をWebSocketで送信しながら検索を実行（stream_report=True でレポートを report_token として逐次送信）"""
     
+    rag_queries_task = None
     try:
-        # ステップ1: キーワード生成
-        await websocket.send_text(json.dumps({
-            "event": "search_progress",
-            "data": SearchProgress(
-                step=1,
-                stage="keyword_generation",
-                message="検索キーワードを生成中...",
-                details={"query": query}
-            ).dict()
-        }, ensure_ascii=False))
-        
-        # AGRフレームワークによる階層的キーワード生成
-        keyword_data = await rag_pipeline.generate_hierarchical_keywords(query)
-        keywords = keyword_data.get('all_keywords', [])
-        hierarchical_keywords = keyword_data.get('hierarchical', {})
-        query_analysis = keyword_data.get('analysis', {})
-        
-        logger.info(f"Generated {len(keywords)} keywords using AGR framework")
-        logger.info(f"Query analysis: {query_analysis.get('intent', 'unknown')} / {query_analysis.get('complexity', 'medium')}")
-        
-        # ステップ2-3: MCP検索（階層的キーワード対応）
-        await websocket.send_text(json.dumps({
-            "event": "search_progress",
-            "data": SearchProgress(
-                step=2,
-                stage="mcp_search",
-                message="MCPサーバーでソースを検索中...",
-                details={
-                    "keywords": keywords,
-                    "hierarchical_strategy": query_analysis.get('search_strategy', '包括検索'),
-                    "primary_keywords": len(hierarchical_keywords.get('primary_keywords', [])),
-                    "secondary_keywords": len(hierarchical_keywords.get('secondary_keywords', [])),
-                    "searching": ["google_drive", "chrome_history"]
+        # 検索結果キャッシュの参照は呼び出し元（同時実行数の制限より前）で行う
+        cache_enabled = get_excluded_folders_config().is_search_cache_enabled()
+        cache_scope = _search_cache_scope(excluded_folder_ids)
+        
+        retrieval = None
+        if RETRIEVAL_CACHE_TTL_SECONDS > 0:
+            retrieval = await retrieval_cache.get(query, cache_scope)
+        
+        if retrieval is not None:
+            # 検索段階をキャッシュから復元し、UIの進捗表示を揃えるため各段階を cached として通知
+            keywords = retrieval["keywords"]
+            rag_queries = retrieval["rag_queries"]
+            sources = retrieval["sources"]
+            document_count = retrieval["document_count"]
+            relevant_docs = retrieval["relevant_docs"]
+            similarity_threshold = get_excluded_folders_config().get_similarity_threshold()
+            await _send_cached_stages(websocket, query, keywords, document_count, rag_queries)
+            logger.info(f"Retrieval cache hit: {len(relevant_docs)} relevant documents")
+        else:
+            # ステップ1: キーワード生成
+            await _send(websocket, {
+                "event": "search_progress",
+                "data": {
+                    **_PROGRESS_STAGES["keyword_generation"],
+                    "details": {"query": query}
                 }
-            ).dict()
-        }, ensure_ascii=False))
-        
-        documents = await rag_pipeline.search_with_mcp(keywords, excluded_folder_ids, keyword_data)
-        logger.info(f"Retrieved {len(documents)} documents from MCP")
-        
-        # 検索結果が0件の場合はエラーを返す
-        if not documents:
-            await websocket.send_text(json.dumps({
-                "event": "error",
-                "message": "検索結果が0件でした。キーワードを変更して再度検索してください。"
-            }, ensure_ascii=False))
-            raise HTTPException(status_code=404, detail="検索結果が0件です")
-        
-        # ステップ4: ベクトル化（適応的最適化対応）
-        await websocket.send_text(json.dumps({
-            "event": "search_progress",
-            "data": SearchProgress(
-                step=4,
-                stage="vectorization",
-                message="取得したドキュメントをベクトル化中...",
-                details={
-                    "total_documents": len(documents),
-                    "processed": len(documents),
-                    "adaptive_chunking": True,
-                    "query_intent": query_analysis.get('intent', 'unknown'),
-                    "sources": {
-                        "google_drive": len([d for d in documents if d.metadata.get("source", "").startswith("google")]),
-                        "chrome_history": len([d for d in documents if d.metadata.get("source", "").startswith("chrome")])
+            })
+        
+            # AGRフレームワークによる階層的キーワード生成
+            keyword_data = await rag_pipeline.generate_hierarchical_keywords(query)
+            # RAGクエリは元クエリのみに依存するため、MCP検索・ベクトル化と並行して生成する
+            rag_queries_task = asyncio.create_task(rag_pipeline.generate_rag_queries(query))
+            keywords = keyword_data.get('all_keywords', [])
+            hierarchical_keywords = keyword_data.get('hierarchical', {})
+            query_analysis = keyword_data.get('analysis', {})
+        
+            logger.info(f"Generated {len(keywords)} keywords using AGR framework")
+            logger.info(f"Query analysis: {query_analysis.get('intent', 'unknown')} / {query_analysis.get('complexity', 'medium')}")
+        
+            # ステップ2-3: MCP検索（階層的キーワード対応）
+            await _send(websocket, {
+                "event": "search_progress",
+                "data": {
+                    **_PROGRESS_STAGES["mcp_search"],
+                    "details": {
+                        "keywords": keywords,
+                        "hierarchical_strategy": query_analysis.get('search_strategy', '包括検索'),
+                        "primary_keywords": len(hierarchical_keywords.get('primary_keywords', [])),
+                        "secondary_keywords": len(hierarchical_keywords.get('secondary_keywords', [])),
+                        "searching": ["google_drive", "chrome_history"]
                     }
                 }
-            ).dict()
-        }, ensure_ascii=False))
-        
-        vector_store = await rag_pipeline.process_and_store_documents(documents, query_analysis)
-        logger.info("Documents processed and stored in vector database")
+            })
+        
+            documents = await rag_pipeline.search_with_mcp(keywords, excluded_folder_ids, keyword_data)
+            retrieved_count = len(documents)
+            logger.info(f"Retrieved {retrieved_count} documents from MCP")
+            documents = rag_pipeline.deduplicate_documents(documents)
+            document_count = len(documents)
+            sources = [doc.metadata for doc in documents]
+        
+            # 検索結果が0件の場合はエラーを返す
+            if not documents:
+                await _send(websocket, {
+                    "event": "error",
+                    "message": "検索結果が0件でした。キーワードを変更して再度検索してください。"
+                })
+                raise HTTPException(status_code=404, detail="検索結果が0件です")
+        
+            # ステップ4: ベクトル化（適応的最適化対応）
+            source_distribution = rag_pipeline.analyze_source_distribution(documents)
+            google_drive_count = chrome_history_count = 0
+            for source, count in source_distribution.items():
+                if source.startswith("google"):
+                    google_drive_count += count
+                elif source.startswith("chrome"):
+                    chrome_history_count += count
+            await _send(websocket, {
+                "event": "search_progress",
+                "data": {
+                    **_PROGRESS_STAGES["vectorization"],
+                    "details": {
+                        "total_documents": document_count,
+                        "processed": document_count,
+                        "duplicates_removed": retrieved_count - document_count,
+                        "adaptive_chunking": True,
+                        "query_intent": query_analysis.get('intent', 'unknown'),
+                        "sources": {
+                            "google_drive": google_drive_count,
+                            "chrome_history": chrome_history_count
+                        }
+                    }
+                }
+            })
         
-        # ベクトルストアを保存
-        if vector_store:
-            await rag_pipeline.save_vector_store()
+            vector_store = await rag_pipeline.process_and_store_documents(documents, query_analysis)
+            logger.info("Documents processed and stored in vector database")
         
-        # ステップ5-6: RAG検索
-        rag_queries = await rag_pipeline.generate_rag_queries(query)
+            # ベクトルストアの保存は予約して、書き込みを検索処理の外で行う
+            if vector_store:
+                rag_pipeline.schedule_save_vector_store()
         
-        await websocket.send_text(json.dumps({
-            "event": "search_progress",
-            "data": SearchProgress(
-                step=5,
-                stage="rag_search",
-                message="セマンティック検索を実行中...",
-                details={"rag_queries": rag_queries}
-            ).dict()
-        }, ensure_ascii=False))
-        
-        # 設定から類似度関連パラメータを取得
-        similarity_threshold = excluded_folders_config.get_similarity_threshold()
-        enable_relevance_check = excluded_folders_config.is_final_relevance_check_enabled()
-        
-        # 最終関連性チェックを無効にする場合はoriginal_queryをNoneに
-        original_query_for_search = query if enable_relevance_check else None
-        
-        relevant_docs = await rag_pipeline.semantic_search(
-            rag_queries, 
-            original_query=original_query_for_search, 
-            similarity_threshold=similarity_threshold
-        )
-        logger.info(f"Semantic search returned {len(relevant_docs)} relevant documents (threshold={similarity_threshold})")
+            # ステップ5-6: RAG検索
+            rag_queries = await rag_queries_task
         
-        # RAG検索結果を進行状況として送信
-        import numpy as np
-        
-        rag_results_data = []
-        for doc in relevant_docs[:10]:  # 最初の10件を送信
-            metadata = getattr(doc, 'metadata', {}).copy()
-            # スコアをメタデータから取得
-            score = metadata.get('similarity_score', getattr(doc, 'score', None))
-            
-            # web_fetchソースをChrome Historyに変更
-            if metadata.get('source') == 'web_fetch':
-                metadata['source'] = 'Chrome History'
-            
-            # Google DriveファイルのURL生成
-            if 'google_drive' in str(metadata.get('source', '')).lower():
-                if 'file_id' in metadata:
-                    metadata['url'] = f"https://drive.google.com/file/d/{metadata['file_id']}/view"
-                elif 'id' in metadata:
-                    metadata['url'] = f"https://drive.google.com/file/d/{metadata['id']}/view"
-            
-            def convert_to_serializable(obj):
-                if isinstance(obj, (np.integer, np.floating, np.bool_)):
-                    return obj.item()
-                elif isinstance(obj, np.ndarray):
-                    return obj.tolist()
-                elif isinstance(obj, dict):
-                    return {k: convert_to_serializable(v) for k, v in obj.items()}
-                elif isinstance(obj, list):
-                    return [convert_to_serializable(item) for item in obj]
-                else:
-                    return obj
-            
-            # 日本語の文字化けを防ぐため、UTF-8エンコーディングを確実にする
-            content = doc.page_content[:500] if hasattr(doc, 'page_content') else str(doc)[:500]
-            
-            # 文字化けの原因となる可能性のある制御文字を除去
-            import re
-            content = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f]', '', content)
+            await _send(websocket, {
+                "event": "search_progress",
+                "data": {
+                    **_PROGRESS_STAGES["rag_search"],
+                    "details": {"rag_queries": rag_queries}
+                }
+            })
+        
+            # 設定から類似度関連パラメータを取得
+            similarity_threshold = get_excluded_folders_config().get_similarity_threshold()
+            enable_relevance_check = get_excluded_folders_config().is_final_relevance_check_enabled()
+        
+            # 最終関連性チェックを無効にする場合はoriginal_queryをNoneに
+            original_query_for_search = query if enable_relevance_check else None
+        
+            # rag_queries の埋め込みは semantic_search 内で1回のバッチ呼び出しにまとめて計算される
+            relevant_docs = await rag_pipeline.semantic_search(
+                rag_queries, 
+                original_query=original_query_for_search, 
+                similarity_threshold=similarity_threshold
+            )
+            logger.info(f"Semantic search returned {len(relevant_docs)} relevant documents (threshold={similarity_threshold})")
             
-            doc_data = {
-                "content": content,
-                "metadata": convert_to_serializable(metadata),
-                "score": convert_to_serializable(score)
-            }
-            rag_results_data.append(doc_data)
+            if RETRIEVAL_CACHE_TTL_SECONDS > 0:
+                await retrieval_cache.set(query, _retrieval_cache_entry(
+                    keywords, rag_queries, sources, document_count, relevant_docs
+                ), cache_scope)
         
-        await websocket.send_text(json.dumps({
-            "event": "search_progress",
-            "data": SearchProgress(
-                step=6,
-                stage="rag_search_complete",
-                message=f"セマンティック検索完了: {len(relevant_docs)}件の関連ドキュメントを発見",
-                details={
-                    "rag_queries": rag_queries,
-                    "results": rag_results_data,
-                    "total_results": len(relevant_docs),
-                    "similarity_threshold": similarity_threshold
-                }
-            ).dict()
-        }, ensure_ascii=False))
+        # RAG検索結果を進行状況として送信
+        rag_results_data = _build_rag_results(relevant_docs)
+        await _send_rag_search_complete(
+            websocket, rag_queries, rag_results_data, len(relevant_docs), similarity_threshold
+        )
         
         # ステップ7: レポート生成
-        await websocket.send_text(json.dumps({
+        await _send(websocket, {
             "event": "search_progress",
-            "data": SearchProgress(
-                step=7,
-                stage="report_generation",
-                message="レポートを生成中...",
-                details={
+            "data": {
+                **_PROGRESS_STAGES["report_generation"],
+                "details": {
                     "relevant_sources": len(relevant_docs),
                     "citations_count": len(relevant_docs)
                 }
-            ).dict()
-        }, ensure_ascii=False))
-        
-        report = await rag_pipeline.generate_report(query, relevant_docs)
+            }
+        })
+        
+        if stream_report:
+            # 生成されたテキストを順次送信し、最初の文字が届くまでの待ち時間を短くする
+            report_parts = []
+            stream = rag_pipeline.generate_report_stream(query, relevant_docs)
+            try:
+                async for token in stream:
+                    if websocket.client_state != WebSocketState.CONNECTED:
+                        # 切断後は受け取る相手がいないため、ストリームを閉じて LLM の生成を打ち切る
+                        raise WebSocketDisconnect()
+                    report_parts.append(token)
+                    await _send(websocket, {
+                        "event": "report_token",
+                        "data": token
+                    })
+            finally:
+                await stream.aclose()
+            report = "".join(report_parts)
+        else:
+            report = await rag_pipeline.generate_report(query, relevant_docs)
         logger.info("Report generated successfully")
         
-        return SearchResult(
+        result = SearchResult.model_construct(
             report=report,
-            sources=[doc.metadata for doc in documents],
+            sources=sources,
             keywords_used=keywords,
             rag_queries=rag_queries,
-            total_documents=len(documents),
+            total_documents=document_count,
             relevant_documents=len(relevant_docs)
         )
+        if cache_enabled:
+            await search_cache.set(query, _search_cache_entry(result, rag_results_data, similarity_threshold), cache_scope)
+        return result
         
+    except WebSocketDisconnect:
+        raise
     except Exception as e:
         logger.error(f"Error in search process: {e}")
-        await websocket.send_text(json.dumps({
+        await _send(websocket, {
             "event": "error",
             "message": f"検索中にエラーが発生しました: {str(e)}"
-        }, ensure_ascii=False))
+        })
         raise
+    finally:
+        # 途中で失敗した場合は並行実行中のRAGクエリ生成を取り消す
+        if rag_queries_task and not rag_queries_task.done():
+            rag_queries_task.cancel()
 
 @app.post("/search", response_model=SearchResult)
 async def search_endpoint(request: QueryRequest):
     """RESTful検索エンドポイント（WebSocketを使わない場合）"""
+    rag_queries_task = None
     try:
         logger.info(f"Search request: {request.query}")
         
-        # 設定ファイルから除外フォルダを自動読み込み（リクエストで指定がない場合）
-        excluded_folder_ids = request.excluded_folder_ids
-        if excluded_folder_ids is None and excluded_folders_config.is_auto_exclude_enabled():
-            excluded_folder_ids = excluded_folders_config.get_excluded_folder_ids()
-            logger.info(f"Auto-loaded {len(excluded_folder_ids)} excluded folders from config")
-        
-        # 簡略化された検索プロセス（AGRフレームワーク対応）
-        keyword_data = await rag_pipeline.generate_hierarchical_keywords(request.query)
-        keywords = keyword_data.get('all_keywords', [])
-        query_analysis = keyword_data.get('analysis', {})
-        
-        logger.info(f"Generated {len(keywords)} keywords using AGR framework")
-        logger.info(f"Query analysis: {query_analysis.get('intent', 'unknown')}")
-        
-        documents = await rag_pipeline.search_with_mcp(keywords, excluded_folder_ids, keyword_data)
-        logger.info(f"Retrieved {len(documents)} documents from MCP")
-        
-        # 検索結果が0件の場合はエラーを返す
-        if not documents:
-            logger.error("No documents found from MCP search")
-            raise HTTPException(status_code=404, detail="検索結果が0件でした。キーワードを変更して再度検索してください。")
-        
-        vector_store = await rag_pipeline.process_and_store_documents(documents, query_analysis)
-        logger.info("Documents processed and stored with adaptive optimization")
-        
-        if vector_store:
-            await rag_pipeline.save_vector_store()
-        
-        rag_queries = await rag_pipeline.generate_rag_queries(request.query)
-        logger.info(f"Generated RAG queries: {rag_queries}")
-        
-        # 設定から類似度関連パラメータを取得
-        similarity_threshold = excluded_folders_config.get_similarity_threshold()
-        enable_relevance_check = excluded_folders_config.is_final_relevance_check_enabled()
-        
-        # 最終関連性チェックを無効にする場合はoriginal_queryをNoneに
-        original_query_for_search = request.query if enable_relevance_check else None
-        
-        relevant_docs = await rag_pipeline.semantic_search(
-            rag_queries, 
-            original_query=original_query_for_search, 
-            similarity_threshold=similarity_threshold
-        )
-        logger.info(f"Semantic search returned {len(relevant_docs)} relevant documents (threshold={similarity_threshold})")
-        
-        report = await rag_pipeline.generate_report(request.query, relevant_docs)
-        logger.info("Report generated")
-        
-        return SearchResult(
-            report=report,
-            sources=[doc.metadata for doc in documents],
-            keywords_used=keywords,
-            rag_queries=rag_queries,
-            total_documents=len(documents),
-            relevant_documents=len(relevant_docs)
-        )
+        excluded_folder_ids = resolve_excluded_folder_ids(request.excluded_folder_ids)
+        
+        cache_enabled = get_excluded_folders_config().is_search_cache_enabled()
+        cache_scope = _search_cache_scope(excluded_folder_ids)
+        cached = await _get_cached_search(request.query, cache_scope)
+        if cached is not None:
+            return SearchResult.model_construct(**cached["result"])
+        
+        async with _search_slot():
+            retrieval = None
+            if RETRIEVAL_CACHE_TTL_SECONDS > 0:
+                retrieval = await retrieval_cache.get(request.query, cache_scope)
+        
+            if retrieval is not None:
+                # 検索段階をキャッシュから復元し、レポート生成のみを行う
+                keywords = retrieval["keywords"]
+                rag_queries = retrieval["rag_queries"]
+                sources = retrieval["sources"]
+                document_count = retrieval["document_count"]
+                relevant_docs = retrieval["relevant_docs"]
+                similarity_threshold = get_excluded_folders_config().get_similarity_threshold()
+                logger.info(f"Retrieval cache hit: {len(relevant_docs)} relevant documents")
+            else:
+                # 簡略化された検索プロセス（AGRフレームワーク対応）
+                keyword_data = await rag_pipeline.generate_hierarchical_keywords(request.query)
+                # RAGクエリは元クエリのみに依存するため、MCP検索・ベクトル化と並行して生成する
+                rag_queries_task = asyncio.create_task(rag_pipeline.generate_rag_queries(request.query))
+                keywords = keyword_data.get('all_keywords', [])
+                query_analysis = keyword_data.get('analysis', {})
+        
+                logger.info(f"Generated {len(keywords)} keywords using AGR framework")
+                logger.info(f"Query analysis: {query_analysis.get('intent', 'unknown')}")
+        
+                documents = await rag_pipeline.search_with_mcp(keywords, excluded_folder_ids, keyword_data)
+                retrieved_count = len(documents)
+                logger.info(f"Retrieved {retrieved_count} documents from MCP")
+                documents = rag_pipeline.deduplicate_documents(documents)
+                document_count = len(documents)
+                sources = [doc.metadata for doc in documents]
+        
+                # 検索結果が0件の場合はエラーを返す
+                if not documents:
+                    logger.error("No documents found from MCP search")
+                    raise HTTPException(status_code=404, detail="検索結果が0件でした。キーワードを変更して再度検索してください。")
+        
+                vector_store = await rag_pipeline.process_and_store_documents(documents, query_analysis)
+                logger.info("Documents processed and stored with adaptive optimization")
+        
+                if vector_store:
+                    rag_pipeline.schedule_save_vector_store()
+        
+                rag_queries = await rag_queries_task
+                logger.info(f"Generated RAG queries: {rag_queries}")
+        
+                # 設定から類似度関連パラメータを取得
+                similarity_threshold = get_excluded_folders_config().get_similarity_threshold()
+                enable_relevance_check = get_excluded_folders_config().is_final_relevance_check_enabled()
+        
+                # 最終関連性チェックを無効にする場合はoriginal_queryをNoneに
+                original_query_for_search = request.query if enable_relevance_check else None
+        
+                relevant_docs = await rag_pipeline.semantic_search(
+                    rag_queries, 
+                    original_query=original_query_for_search, 
+                    similarity_threshold=similarity_threshold
+                )
+                logger.info(f"Semantic search returned {len(relevant_docs)} relevant documents (threshold={similarity_threshold})")
+            
+                if RETRIEVAL_CACHE_TTL_SECONDS > 0:
+                    await retrieval_cache.set(request.query, _retrieval_cache_entry(
+                        keywords, rag_queries, sources, document_count, relevant_docs
+                    ), cache_scope)
+        
+            report = await rag_pipeline.generate_report(request.query, relevant_docs)
+            logger.info("Report generated")
+        
+            result = SearchResult.model_construct(
+                report=report,
+                sources=sources,
+                keywords_used=keywords,
+                rag_queries=rag_queries,
+                total_documents=document_count,
+                relevant_documents=len(relevant_docs)
+            )
+            if cache_enabled:
+                # WebSocket 経由の同じクエリでもRAG検索結果を再送できるよう表示用の結果も保存する
+                await search_cache.set(request.query, _search_cache_entry(
+                    result, _build_rag_results(relevant_docs), similarity_threshold
+                ), cache_scope)
+            return result
         
     except Exception as e:
         logger.error(f"Search endpoint error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if rag_queries_task and not rag_queries_task.done():
+            rag_queries_task.cancel()
 
 # 除外フォルダ設定管理エンドポイント
 
@@ -400,9 +720,9 @@ async def get_excluded_folders():
     """除外フォルダ設定を取得"""
     try:
         return {
-            "excluded_folders": excluded_folders_config.get_excluded_folders(),
-            "settings": excluded_folders_config.get_settings(),
-            "total_enabled": len(excluded_folders_config.get_excluded_folder_ids())
+            "excluded_folders": get_excluded_folders_config().get_excluded_folders(),
+            "settings": get_excluded_folders_config().get_settings(),
+            "total_enabled": get_excluded_folders_config().excluded_count
         }
     except Exception as e:
         logger.error(f"Error getting excluded folders config: {e}")
@@ -412,7 +732,7 @@ async def get_excluded_folders():
 async def add_excluded_folder(request: ExcludedFolderRequest):
     """除外フォルダを追加"""
     try:
-        success = excluded_folders_config.add_excluded_folder(
+        success = get_excluded_folders_config().add_excluded_folder(
             folder_id=request.folder_id,
             name=request.name,
             description=request.description,
@@ -423,7 +743,7 @@ async def add_excluded_folder(request: ExcludedFolderRequest):
             return {
                 "success": True,
                 "message": f"Added excluded folder: {request.folder_id}",
-                "total_excluded": len(excluded_folders_config.get_excluded_folder_ids())
+                "total_excluded": get_excluded_folders_config().excluded_count
             }
         else:
             raise HTTPException(status_code=400, detail="Failed to add excluded folder")
@@ -436,13 +756,13 @@ async def add_excluded_folder(request: ExcludedFolderRequest):
 async def remove_excluded_folder(folder_id: str):
     """除外フォルダを削除"""
     try:
-        success = excluded_folders_config.remove_excluded_folder(folder_id)
+        success = get_excluded_folders_config().remove_excluded_folder(folder_id)
         
         if success:
             return {
                 "success": True,
                 "message": f"Removed excluded folder: {folder_id}",
-                "total_excluded": len(excluded_folders_config.get_excluded_folder_ids())
+                "total_excluded": get_excluded_folders_config().excluded_count
             }
         else:
             raise HTTPException(status_code=404, detail="Excluded folder not found")
@@ -455,7 +775,7 @@ async def remove_excluded_folder(folder_id: str):
 async def toggle_excluded_folder(folder_id: str):
     """除外フォルダの有効/無効を切り替え"""
     try:
-        enabled = excluded_folders_config.toggle_excluded_folder(folder_id)
+        enabled = get_excluded_folders_config().toggle_excluded_folder(folder_id)
         
         if enabled is not None:
             return {
@@ -463,7 +783,7 @@ async def toggle_excluded_folder(folder_id: str):
                 "folder_id": folder_id,
                 "enabled": enabled,
                 "message": f"Folder {'enabled' if enabled else 'disabled'}",
-                "total_excluded": len(excluded_folders_config.get_excluded_folder_ids())
+                "total_excluded": get_excluded_folders_config().excluded_count
             }
         else:
             raise HTTPException(status_code=404, detail="Excluded folder not found")
@@ -476,13 +796,13 @@ async def toggle_excluded_folder(folder_id: str):
 async def update_config_settings(request: ConfigSettingsRequest):
     """設定を更新"""
     try:
-        success = excluded_folders_config.update_settings(request.settings)
+        success = get_excluded_folders_config().update_settings(request.settings)
         
         if success:
             return {
                 "success": True,
                 "message": "Settings updated successfully",
-                "settings": excluded_folders_config.get_settings()
+                "settings": get_excluded_folders_config().get_settings()
             }
         else:
             raise HTTPException(status_code=400, detail="Failed to update settings")
@@ -495,13 +815,17 @@ async def update_config_settings(request: ConfigSettingsRequest):
 async def reload_excluded_folders_config():
     """設定ファイルを再読み込み"""
     try:
-        success = excluded_folders_config.load_config()
+        success = get_excluded_folders_config().load_config()
         
         if success:
+            # 再読み込み前の設定で作られた結果を使わないよう、各キャッシュを破棄する
+            search_cache.clear()
+            retrieval_cache.clear()
+            rag_pipeline.clear_query_caches()
             return {
                 "success": True,
                 "message": "Configuration reloaded successfully",
-                "total_excluded": len(excluded_folders_config.get_excluded_folder_ids())
+                "total_excluded": get_excluded_folders_config().excluded_count
             }
         else:
             raise HTTPException(status_code=500, detail="Failed to reload configuration")
@@ -511,5 +835,17 @@ async def reload_excluded_folders_config():
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # WEB_CONCURRENCY > 1 でマルチプロセス化する（ベクトルストア・各キャッシュはプロセスごとに保持され、
+    # 除外フォルダ設定の変更は他のワーカーでは /config/excluded-folders/reload まで反映されない）
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    # uvloop / httptools（uvicorn[standard] に含まれる）があれば明示的に使用し、
+    # 未インストールの環境（Windows の uvloop など）では標準実装にフォールバックする
+    server_options = {
+        "loop": "uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        "http": "httptools" if importlib.util.find_spec("httptools") else "h11",
+        "ws": "websockets",
+    }
+    if workers > 1:
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers, **server_options)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000, **server_options)
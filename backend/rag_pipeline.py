@@ -4,20 +4,66 @@ RAG Pipeline Implementation with LangChain, FAISS, and Google Gemini
 
 import os
 import asyncio
-from typing import List, Dict, Any, Optional
+import hashlib
+import pickle
+import shutil
+import traceback
+from collections import Counter
+from typing import List, Dict, Any, Optional, AsyncIterator, FrozenSet, Tuple
+from urllib.parse import urlparse
 import logging
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
 from langchain.docstore.document import Document
-from langchain.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import FAISS
 import httpx
+import aiofiles
+import faiss
+import numpy as np
 from llm_query_generator import LLMQueryGenerator
-from adaptive_faiss_optimizer import AdaptiveFAISSOptimizer
+from adaptive_faiss_optimizer import AdaptiveFAISSOptimizer, build_hnsw_index, mmr_select
+from config_manager import get_excluded_folders_config
 
 logger = logging.getLogger(__name__)
 
+# ベクトルストア保存の遅延時間（秒）。この間の保存要求は1回の書き込みにまとめる
+_VECTOR_STORE_SAVE_DELAY = float(os.getenv("VECTOR_STORE_SAVE_DELAY", "5.0"))
+
+# プロンプトテンプレート（str.format_map で埋め込む）
+# 最終関連性チェック
+_RELEVANCE_PROMPT = """ユーザークエリ: "{query}"
+
+以下のドキュメントの中から、ユーザークエリに関連性が高いものを選択してください。
+関連性が低い、または無関係なドキュメントは除外してください。
+
+ドキュメント一覧:
+{summaries}
+
+関連性が高いドキュメントの番号を、関連性の高い順にカンマ区切りで返してください。
+例: 0,3,7,2
+
+番号のみを返してください。説明は不要です。
+"""
+
+# レポート生成
+_REPORT_PROMPT = """質問: {question}
+
+以下の情報源を基に、構造化されたレポートをマークダウン形式で作成してください．数式はKatexで対応しています．
+参考にした文献はURLのリンク埋め込みを行ってください．ただし，レポートの見やすさのため，'[[1]](URL)'のようにURLのタイトルは番号で示してください．
+見やすいレポート作りを徹底してください．
+なお， **ユーザの質問に関連がない** と判断した情報は無視してください．：
+
+{context}
+
+レポートには以下を含めてください：
+1. **要約（Executive Summary）** - 重要なポイントを簡潔に
+2. **詳細な分析** - 情報源から得られた具体的な内容
+3. **重要なポイント** - 箇条書きで主要な発見事項
+4. **結論** - 質問に対する総合的な回答
+マークダウン形式で、読みやすく構造化して出力してください。
+各情報には適切な引用を含めてください。参考文献は不要です．"""
+
 class RAGPipeline:
     def __init__(self):
         self.llm = None
@@ -27,12 +73,47 @@ class RAGPipeline:
         self.mcp_server_url = os.getenv("MCP_SERVER_URL", "http://localhost:8501")
         self.query_generator = None
         self.faiss_optimizer = AdaptiveFAISSOptimizer()  # 新しい最適化コンポーネント
+        # 遅延保存の状態（未保存の変更フラグ、待機中の保存タスク、即時保存の合図）
+        self._vector_store_dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+        self._save_now: Optional[asyncio.Event] = None
+        # MCPサーバーへの接続を使い回す共有クライアント（ainit または初回使用時に作成）
+        self._http_client: Optional[httpx.AsyncClient] = None
         self._clear_vector_store_cache()  # 起動時にキャッシュをクリア
         self._initialize_models()
     
+    async def ainit(self):
+        """起動時の準備: 共有HTTPクライアントの作成と埋め込みモデルへの接続の確立"""
+        self._get_http_client()
+        if self.embeddings:
+            try:
+                await self.embeddings.aembed_query("warmup")
+                logger.info("Embedding model warmed up")
+            except Exception as e:
+                logger.warning(f"Embedding warmup failed: {e}")
+    
+    async def aclose(self):
+        """共有HTTPクライアントを閉じる"""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+    
+    def clear_query_caches(self):
+        """キーワード・RAGクエリ生成のキャッシュを破棄"""
+        if self.query_generator:
+            self.query_generator.clear_cache()
+    
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """MCPサーバー用の共有HTTPクライアントを取得（接続はリクエスト間で再利用される）"""
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                timeout=180.0,
+                limits=httpx.Limits(max_keepalive_connections=64, max_connections=128)
+            )
+        return self._http_client
+    
     def _clear_vector_store_cache(self):
         """ベクターストアキャッシュファイルを削除"""
-        import shutil
         cache_path = "./vector_store_cache"
         try:
             if os.path.exists(cache_path):
@@ -72,7 +153,7 @@ class RAGPipeline:
             
             # LLM Query Generator の初期化
             logger.info("Initializing LLM Query Generator...")
-            self.query_generator = LLMQueryGenerator(self.llm)
+            self.query_generator = LLMQueryGenerator(self.llm, self.embeddings)
             logger.info("LLM Query Generator initialized successfully")
             
             logger.info("RAG pipeline models initialized successfully")
@@ -80,7 +161,6 @@ class RAGPipeline:
         except Exception as e:
             logger.error(f"Failed to initialize RAG models: {e}")
             logger.error(f"Exception details: {type(e).__name__}: {str(e)}")
-            import traceback
             logger.error(f"Full traceback: {traceback.format_exc()}")
             logger.warning("RAG pipeline functionality will be limited without proper API configuration")
             # Ensure query_generator is None for proper error handling
@@ -98,20 +178,11 @@ class RAGPipeline:
             # LLM Query Generator を使用（AGRフレームワーク）
             keyword_data = await self.query_generator.generate_diverse_keywords(user_query)
             
-            # 全てのキーワードを取得
-            all_keywords = keyword_data.get('all_keywords', [])
+            # 全てのキーワードを取得（重複除去は generate_diverse_keywords で済んでいる）
+            unique_keywords = keyword_data.get('all_keywords', [])
             hierarchical = keyword_data.get('hierarchical', {})
             analysis = keyword_data.get('analysis', {})
             
-            # 重複除去
-            unique_keywords = []
-            seen = set()
-            
-            for keyword in all_keywords:
-                if keyword.lower() not in seen:
-                    unique_keywords.append(keyword)
-                    seen.add(keyword.lower())
-            
             logger.info(f"AGR keyword generation produced {len(unique_keywords)} keywords")
             logger.info(f"Query analysis: {analysis.get('intent', 'unknown')} / {analysis.get('complexity', 'medium')}")
             
@@ -134,176 +205,22 @@ class RAGPipeline:
             raise RuntimeError(f"Failed to generate keywords with LLM: {e}")
     
     
-    async def search_with_mcp(self, keywords: List[str], excluded_folder_ids: Optional[List[str]] = None, hierarchical_keywords: Optional[Dict[str, Any]] = None) -> List[Document]:
-        """MCPサーバーを使用してドキュメントを検索"""
+    async def search_with_mcp(self, keywords: List[str], excluded_folder_ids: Optional[FrozenSet[str]] = None, hierarchical_keywords: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """MCPサーバーを使用してドキュメントを検索（各ソースへの問い合わせは並行して行う）"""
         
         documents = []
         
         try:
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                # Google Drive検索 - 階層的キーワード対応
-                try:
-                    if hierarchical_keywords:
-                        # 階層的キーワードを使用した最適化検索
-                        actual_hierarchical = hierarchical_keywords.get('hierarchical', {})
-                        # MCPサーバーが期待する形式に合わせて、余分なフィールドを除去
-                        clean_hierarchical = {
-                            key: value for key, value in actual_hierarchical.items()
-                            if key in ['primary_keywords', 'secondary_keywords', 'context_keywords', 'negative_keywords']
-                        }
-                        gdrive_request = {
-                            "hierarchical_keywords": clean_hierarchical,
-                            "file_types": ["document", "sheet", "pdf", "markdown"],
-                            "max_results": 100
-                        }
-                        logger.info(f"Using hierarchical keywords for Google Drive search")
-                        logger.info(f"Sending clean hierarchical_keywords: {clean_hierarchical}")
-                    else:
-                        # 従来のキーワード検索
-                        gdrive_request = {
-                            "keywords": keywords,
-                            "file_types": ["document", "sheet", "pdf", "markdown"],
-                            "max_results": 100
-                        }
-                        logger.info(f"Using simple keywords for Google Drive search: {keywords[:3]}...")
-                    
-                    # 除外フォルダがある場合は追加
-                    if excluded_folder_ids:
-                        gdrive_request["excluded_folder_ids"] = excluded_folder_ids
-                        logger.info(f"Google Drive search excluding folders: {excluded_folder_ids}")
-                    
-                    gdrive_response = await client.post(
-                        f"{self.mcp_server_url}/tools/search_google_drive",
-                        json=gdrive_request
-                    )
-                    logger.info(f"Google Drive response status: {gdrive_response.status_code}")
-                    if gdrive_response.status_code == 200:
-                        gdrive_results = gdrive_response.json()
-                        logger.info(f"Google Drive returned {len(gdrive_results)} results")
-                        for item in gdrive_results:
-                            documents.append(Document(
-                                page_content=item.get("content", ""),
-                                metadata=item.get("metadata", {})
-                            ))
-                    else:
-                        logger.error(f"Google Drive search HTTP error: {gdrive_response.status_code} - {gdrive_response.text}")
-                except Exception as e:
-                    logger.error(f"Google Drive search failed: {e}")
-                
-                # Chrome履歴検索
-                try:
-                    chrome_response = await client.post(
-                        f"{self.mcp_server_url}/tools/search_chrome_history",
-                        json={
-                            "keywords": keywords,
-                            "days": 90,
-                            "max_results": 100
-                        }
-                    )
-                    logger.info(f"Chrome history response status: {chrome_response.status_code}")
-                    if chrome_response.status_code == 200:
-                        chrome_results = chrome_response.json()
-                        logger.info(f"Chrome history returned {len(chrome_results)} results")
-                        urls_to_fetch = []
-                        
-                        for item in chrome_results:
-                            # Add Chrome history as document
-                            documents.append(Document(
-                                page_content=item.get("content", ""),
-                                metadata=item.get("metadata", {})
-                            ))
-                            
-                            # Collect URLs for web fetching
-                            url = item.get("url")
-                            if url and self._is_fetchable_url(url):
-                                urls_to_fetch.append(url)
-                        # Fetch web content from URLs
-                        if urls_to_fetch:
-                            try:
-                                logger.info(f"Fetching {len(urls_to_fetch)} URLs from Chrome history")
-                                web_response = await client.post(
-                                    f"{self.mcp_server_url}/tools/web_fetch",
-                                    json={
-                                        "urls": urls_to_fetch[:50],  # Limit to 20 URLs
-                                        "max_concurrent": 3
-                                    }
-                                )
-                                logger.info(f"Web fetch response status: {web_response.status_code}")
-                                if web_response.status_code == 200:
-                                    web_results = web_response.json()
-                                    web_data = web_results.get("data", []) if isinstance(web_results, dict) else web_results
-                                    logger.info(f"Web fetch returned {len(web_data)} results")
-                                    for web_item in web_data:
-                                        documents.append(Document(
-                                            page_content=web_item.get("content", ""),
-                                            metadata={
-                                                **web_item.get("metadata", {}),
-                                                "source": "web_fetch",
-                                                "fetched_from_history": True
-                                            }
-                                        ))
-                                else:
-                                    logger.error(f"Web fetch HTTP error: {web_response.status_code} - {web_response.text}")
-                            except Exception as e:
-                                logger.warning(f"Web fetch failed: {e}")
-                    else:
-                        logger.error(f"Chrome history search HTTP error: {chrome_response.status_code} - {chrome_response.text}")
-                except Exception as e:
-                    logger.error(f"Chrome history search failed: {e}")
-                
-                # ChatGPT履歴検索
-                try:
-                    chatgpt_response = await client.post(
-                        f"{self.mcp_server_url}/tools/search_chatgpt_history",
-                        json={
-                            "keywords": keywords,
-                            "days": 90,
-                            "max_results": 100
-                        }
-                    )
-                    logger.info(f"ChatGPT history response status: {chatgpt_response.status_code}")
-                    if chatgpt_response.status_code == 200:
-                        chatgpt_results = chatgpt_response.json()
-                        logger.info(f"ChatGPT history returned {len(chatgpt_results)} results")
-                        
-                        for item in chatgpt_results:
-                            # Add ChatGPT conversation as document
-                            documents.append(Document(
-                                page_content=item.get("content", ""),
-                                metadata=item.get("metadata", {})
-                            ))
-                    else:
-                        logger.error(f"ChatGPT history search HTTP error: {chatgpt_response.status_code} - {chatgpt_response.text}")
-                                
-                except Exception as e:
-                    logger.error(f"ChatGPT history search failed: {e}")
-
-                # Gemini履歴検索
-                try:
-                    gemini_response = await client.post(
-                        f"{self.mcp_server_url}/tools/search_gemini_history",
-                        json={
-                            "keywords": keywords,
-                            "days": 90,
-                            "max_results": 100
-                        }
-                    )
-                    logger.info(f"Gemini history response status: {gemini_response.status_code}")
-                    if gemini_response.status_code == 200:
-                        gemini_results = gemini_response.json()
-                        logger.info(f"Gemini history returned {len(gemini_results)} results")
-                        
-                        for item in gemini_results:
-                            # Add Gemini conversation as document
-                            documents.append(Document(
-                                page_content=item.get("content", ""),
-                                metadata=item.get("metadata", {})
-                            ))
-                    else:
-                        logger.error(f"Gemini history search HTTP error: {gemini_response.status_code} - {gemini_response.text}")
-                                
-                except Exception as e:
-                    logger.error(f"Gemini history search failed: {e}")
+            client = self._get_http_client()
+            # ソースごとの検索は互いに独立しているため同時に発行する（結果はソース順に結合）
+            results = await asyncio.gather(
+                self._search_google_drive(client, keywords, excluded_folder_ids, hierarchical_keywords),
+                self._search_chrome_history(client, keywords),
+                self._search_conversation_history(client, keywords, "search_chatgpt_history", "ChatGPT"),
+                self._search_conversation_history(client, keywords, "search_gemini_history", "Gemini")
+            )
+            for source_documents in results:
+                documents.extend(source_documents)
         
         except Exception as e:
             logger.error(f"MCP search failed: {e}")
@@ -313,6 +230,152 @@ class RAGPipeline:
         logger.info(f"Retrieved {len(documents)} documents from MCP search")
         return documents
     
+    async def _search_google_drive(self, client: httpx.AsyncClient, keywords: List[str], excluded_folder_ids: Optional[FrozenSet[str]], hierarchical_keywords: Optional[Dict[str, Any]]) -> List[Document]:
+        """Google Drive検索 - 階層的キーワード対応"""
+        documents = []
+        try:
+            if hierarchical_keywords:
+                # 階層的キーワードを使用した最適化検索
+                actual_hierarchical = hierarchical_keywords.get('hierarchical', {})
+                # MCPサーバーが期待する形式に合わせて、余分なフィールドを除去
+                clean_hierarchical = {
+                    key: value for key, value in actual_hierarchical.items()
+                    if key in ['primary_keywords', 'secondary_keywords', 'context_keywords', 'negative_keywords']
+                }
+                gdrive_request = {
+                    "hierarchical_keywords": clean_hierarchical,
+                    "file_types": ["document", "sheet", "pdf", "markdown"],
+                    "max_results": 100
+                }
+                logger.info(f"Using hierarchical keywords for Google Drive search")
+                logger.info(f"Sending clean hierarchical_keywords: {clean_hierarchical}")
+            else:
+                # 従来のキーワード検索
+                gdrive_request = {
+                    "keywords": keywords,
+                    "file_types": ["document", "sheet", "pdf", "markdown"],
+                    "max_results": 100
+                }
+                logger.info(f"Using simple keywords for Google Drive search: {keywords[:3]}...")
+            
+            # 除外フォルダがある場合は追加
+            if excluded_folder_ids:
+                gdrive_request["excluded_folder_ids"] = sorted(excluded_folder_ids)
+                logger.info(f"Google Drive search excluding folders: {excluded_folder_ids}")
+            
+            gdrive_response = await client.post(
+                f"{self.mcp_server_url}/tools/search_google_drive",
+                json=gdrive_request
+            )
+            logger.info(f"Google Drive response status: {gdrive_response.status_code}")
+            if gdrive_response.status_code == 200:
+                gdrive_results = gdrive_response.json()
+                logger.info(f"Google Drive returned {len(gdrive_results)} results")
+                for item in gdrive_results:
+                    documents.append(Document(
+                        page_content=item.get("content", ""),
+                        metadata=item.get("metadata", {})
+                    ))
+            else:
+                logger.error(f"Google Drive search HTTP error: {gdrive_response.status_code} - {gdrive_response.text}")
+        except Exception as e:
+            logger.error(f"Google Drive search failed: {e}")
+        return documents
+    
+    async def _search_chrome_history(self, client: httpx.AsyncClient, keywords: List[str]) -> List[Document]:
+        """Chrome履歴検索（履歴中のURLの本文取得を含む）"""
+        documents = []
+        try:
+            chrome_response = await client.post(
+                f"{self.mcp_server_url}/tools/search_chrome_history",
+                json={
+                    "keywords": keywords,
+                    "days": 90,
+                    "max_results": 100
+                }
+            )
+            logger.info(f"Chrome history response status: {chrome_response.status_code}")
+            if chrome_response.status_code == 200:
+                chrome_results = chrome_response.json()
+                logger.info(f"Chrome history returned {len(chrome_results)} results")
+                urls_to_fetch = []
+                
+                for item in chrome_results:
+                    # Add Chrome history as document
+                    documents.append(Document(
+                        page_content=item.get("content", ""),
+                        metadata=item.get("metadata", {})
+                    ))
+                    
+                    # Collect URLs for web fetching
+                    url = item.get("url")
+                    if url and self._is_fetchable_url(url):
+                        urls_to_fetch.append(url)
+                # Fetch web content from URLs
+                if urls_to_fetch:
+                    try:
+                        logger.info(f"Fetching {len(urls_to_fetch)} URLs from Chrome history")
+                        web_response = await client.post(
+                            f"{self.mcp_server_url}/tools/web_fetch",
+                            json={
+                                "urls": urls_to_fetch[:50],  # Limit to 20 URLs
+                                "max_concurrent": 3
+                            }
+                        )
+                        logger.info(f"Web fetch response status: {web_response.status_code}")
+                        if web_response.status_code == 200:
+                            web_results = web_response.json()
+                            web_data = web_results.get("data", []) if isinstance(web_results, dict) else web_results
+                            logger.info(f"Web fetch returned {len(web_data)} results")
+                            for web_item in web_data:
+                                documents.append(Document(
+                                    page_content=web_item.get("content", ""),
+                                    metadata={
+                                        **web_item.get("metadata", {}),
+                                        "source": "web_fetch",
+                                        "fetched_from_history": True
+                                    }
+                                ))
+                        else:
+                            logger.error(f"Web fetch HTTP error: {web_response.status_code} - {web_response.text}")
+                    except Exception as e:
+                        logger.warning(f"Web fetch failed: {e}")
+            else:
+                logger.error(f"Chrome history search HTTP error: {chrome_response.status_code} - {chrome_response.text}")
+        except Exception as e:
+            logger.error(f"Chrome history search failed: {e}")
+        return documents
+    
+    async def _search_conversation_history(self, client: httpx.AsyncClient, keywords: List[str], tool: str, label: str) -> List[Document]:
+        """ChatGPT / Gemini の会話履歴検索"""
+        documents = []
+        try:
+            response = await client.post(
+                f"{self.mcp_server_url}/tools/{tool}",
+                json={
+                    "keywords": keywords,
+                    "days": 90,
+                    "max_results": 100
+                }
+            )
+            logger.info(f"{label} history response status: {response.status_code}")
+            if response.status_code == 200:
+                results = response.json()
+                logger.info(f"{label} history returned {len(results)} results")
+                
+                for item in results:
+                    # Add conversation as document
+                    documents.append(Document(
+                        page_content=item.get("content", ""),
+                        metadata=item.get("metadata", {})
+                    ))
+            else:
+                logger.error(f"{label} history search HTTP error: {response.status_code} - {response.text}")
+                    
+        except Exception as e:
+            logger.error(f"{label} history search failed: {e}")
+        return documents
+    
     async def process_and_store_documents(self, documents: List[Document], query_analysis: Optional[Dict[str, Any]] = None) -> Optional[FAISS]:
         """ドキュメントを処理してFAISSベクトルストアに保存"""
         
@@ -368,6 +431,12 @@ class RAGPipeline:
                 documents=splits,
                 embedding=self.embeddings
             )
+            # チャンク数が多い場合は近似最近傍探索（HNSW）に切り替える
+            self.vector_store.index = await asyncio.to_thread(
+                build_hnsw_index,
+                self.vector_store.index,
+                get_excluded_folders_config().get_embed_quant()
+            )
             
             # 適応的パラメータでリトリーバーを更新
             self.retriever = self.vector_store.as_retriever(
@@ -395,7 +464,8 @@ class RAGPipeline:
         
         chunk_size = chunk_config.get("chunk_size", 1000)
         chunk_overlap = chunk_config.get("chunk_overlap", 200)
-        separators = chunk_config.get("separators", ["\n\n", "\n", "。", ".", " ", ""])
+        # オプティマイザは共有の tuple を返すため、スプリッタ用にここで一度だけ list 化する
+        separators = list(chunk_config.get("separators", ["\n\n", "\n", "。", ".", " ", ""]))
         
         for doc in documents:
             try:
@@ -479,33 +549,36 @@ class RAGPipeline:
         try:
             relevant_docs_with_scores = []
             
-            for query in queries:
-                try:
-                    # similarity_search_with_score を使用してスコア付きで検索
-                    docs_with_scores = await asyncio.to_thread(
-                        self.vector_store.similarity_search_with_score,
-                        query,
-                        k=self.retriever.search_kwargs.get("k", 6)
-                    )
+            # 全クエリの埋め込みを1回のバッチ呼び出しで計算し、ベクトルで検索する
+            query_vectors = await self._embed_queries(queries)
+            search_kwargs = self.retriever.search_kwargs
+            k = search_kwargs.get("k", 6)
+            if self.retriever.search_type == "mmr":
+                # 適応的パラメータの fetch_k / lambda_mult で多様性を考慮して選択する
+                fetch_k = search_kwargs.get("fetch_k", 20)
+                lambda_mult = search_kwargs.get("lambda_mult", 0.5)
+                search = lambda vector: self._mmr_search_with_score_by_vector(vector, k, fetch_k, lambda_mult)
+            else:
+                search = lambda vector: self.vector_store.similarity_search_with_score_by_vector(vector, k=k)
+            all_docs_with_scores = await asyncio.to_thread(
+                lambda: [search(vector) for vector in query_vectors]
+            )
+            
+            for query, docs_with_scores in zip(queries, all_docs_with_scores):
+                # スコアと共にドキュメントを保存
+                for doc, score in docs_with_scores:
+                    # FAISSでは距離が小さいほど類似度が高い（0に近いほど類似）
+                    # 類似度スコアに変換: similarity = 1 / (1 + distance)
+                    similarity_score = 1.0 / (1.0 + score)
                     
-                    # スコアと共にドキュメントを保存
-                    for doc, score in docs_with_scores:
-                        # FAISSでは距離が小さいほど類似度が高い（0に近いほど類似）
-                        # 類似度スコアに変換: similarity = 1 / (1 + distance)
-                        similarity_score = 1.0 / (1.0 + score)
-                        
-                        # 類似度閾値でフィルタリング
-                        if similarity_score >= similarity_threshold:
-                            relevant_docs_with_scores.append({
-                                'document': doc,
-                                'similarity_score': similarity_score,
-                                'distance': score,
-                                'query': query
-                            })
-                            
-                except Exception as e:
-                    logger.error(f"Error in semantic search for query '{query}': {e}")
-                    continue
+                    # 類似度閾値でフィルタリング
+                    if similarity_score >= similarity_threshold:
+                        relevant_docs_with_scores.append({
+                            'document': doc,
+                            'similarity_score': similarity_score,
+                            'distance': score,
+                            'query': query
+                        })
             
             # 類似度スコアでソート（高い順）
             relevant_docs_with_scores.sort(key=lambda x: x['similarity_score'], reverse=True)
@@ -529,8 +602,7 @@ class RAGPipeline:
                     unique_docs.append(doc)
             
             # 最終的な関連性チェック（元クエリとの関連性）
-            from config_manager import excluded_folders_config
-            max_docs_for_check = excluded_folders_config.get_max_documents_for_relevance_check()
+            max_docs_for_check = get_excluded_folders_config().get_max_documents_for_relevance_check()
             
             if original_query and len(unique_docs) > 10:
                 filtered_docs = await self._final_relevance_check(original_query, unique_docs[:max_docs_for_check])
@@ -562,6 +634,33 @@ class RAGPipeline:
             # フォールバック: 元の方法を使用
             return await self._fallback_semantic_search(queries)
     
+    def _mmr_search_with_score_by_vector(self, vector: List[float], k: int, fetch_k: int, lambda_mult: float) -> List[Tuple[Document, float]]:
+        """上位 fetch_k 件の候補から MMR で k 件を選択（スコアは similarity_search_with_score と同じ L2 距離）"""
+        index = self.vector_store.index
+        query = np.asarray([vector], dtype=np.float32)
+        distances, ids = index.search(query, min(fetch_k, index.ntotal))
+        valid = ids[0] >= 0
+        candidate_ids = ids[0][valid]
+        candidate_distances = distances[0][valid]
+        if len(candidate_ids) == 0:
+            return []
+        
+        candidate_vectors = index.reconstruct_batch(candidate_ids)
+        results = []
+        for i in mmr_select(query[0], candidate_vectors, k, lambda_mult):
+            doc = self.vector_store.docstore.search(self.vector_store.index_to_docstore_id[int(candidate_ids[i])])
+            if isinstance(doc, Document):
+                results.append((doc, float(candidate_distances[i])))
+        return results
+    
+    async def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """検索クエリの埋め込みをまとめて計算（embed_query と同じ retrieval_query タスクを指定）"""
+        try:
+            return await asyncio.to_thread(self.embeddings.embed_documents, queries, task_type="retrieval_query")
+        except TypeError:
+            # task_type を受け付けない埋め込みモデルではクエリごとに計算する
+            return await asyncio.gather(*(self.embeddings.aembed_query(query) for query in queries))
+    
     async def _fallback_semantic_search(self, queries: List[str]) -> List[Document]:
         """フォールバック用のセマンティック検索（スコアなし）"""
         try:
@@ -610,24 +709,12 @@ class RAGPipeline:
                 doc_summaries.append(f"[{i}] {doc.metadata.get('title', 'Untitled')}: {content_preview}")
             
             # LLMに関連性判定を依頼
-            relevance_prompt = f"""
-            ユーザークエリ: "{original_query}"
+            relevance_prompt = _RELEVANCE_PROMPT.format_map({
+                "query": original_query,
+                "summaries": "\n".join(doc_summaries)
+            })
             
-            以下のドキュメントの中から、ユーザークエリに関連性が高いものを選択してください。
-            関連性が低い、または無関係なドキュメントは除外してください。
-            
-            ドキュメント一覧:
-            {chr(10).join(doc_summaries)}
-            
-            関連性が高いドキュメントの番号を、関連性の高い順にカンマ区切りで返してください。
-            例: 0,3,7,2
-            
-            番号のみを返してください。説明は不要です。
-            """
-            
-            response = await asyncio.to_thread(
-                lambda: self.llm.invoke(relevance_prompt)
-            )
+            response = await self.llm.ainvoke(relevance_prompt)
             
             # レスポンスから番号を抽出
             selected_indices = []
@@ -664,38 +751,7 @@ class RAGPipeline:
             raise RuntimeError("LLM not available - cannot generate report")
         
         try:
-            # コンテキストの準備
-            context = "\n\n---\n\n".join([
-                f"**出典**: {doc.metadata}\n**内容**: {doc.page_content}"
-                for doc in context_docs
-            ])
-            
-            report_prompt = PromptTemplate(
-                template="""質問: {question}
-                
-                以下の情報源を基に、構造化されたレポートをマークダウン形式で作成してください．数式はKatexで対応しています．
-                参考にした文献はURLのリンク埋め込みを行ってください．ただし，レポートの見やすさのため，'[[1]](URL)'のようにURLのタイトルは番号で示してください．
-                見やすいレポート作りを徹底してください．
-                なお， **ユーザの質問に関連がない** と判断した情報は無視してください．：
-                
-                {context}
-                
-                レポートには以下を含めてください：
-                1. **要約（Executive Summary）** - 重要なポイントを簡潔に
-                2. **詳細な分析** - 情報源から得られた具体的な内容
-                3. **重要なポイント** - 箇条書きで主要な発見事項
-                4. **結論** - 質問に対する総合的な回答
-                マークダウン形式で、読みやすく構造化して出力してください。
-                各情報には適切な引用を含めてください。参考文献は不要です．""",
-                input_variables=["question", "context"]
-            )
-            
-            response = await asyncio.to_thread(
-                lambda: self.llm.invoke(report_prompt.format(
-                    question=query,
-                    context=context
-                ))
-            )
+            response = await self.llm.ainvoke(self._build_report_prompt(query, context_docs))
             
             logger.info("Report generated successfully")
             return response.content
@@ -704,18 +760,98 @@ class RAGPipeline:
             logger.error(f"Error generating report: {e}")
             raise RuntimeError(f"Failed to generate report with LLM: {e}")
     
+    async def generate_report_stream(self, query: str, context_docs: List[Document]) -> AsyncIterator[str]:
+        """構造化レポートを生成しながら、生成されたテキストを順次返す
+
+        呼び出し側が途中で aclose() した場合は LLM のストリームも閉じ、生成を打ち切る。
+        """
+        
+        if not self.llm:
+            raise RuntimeError("LLM not available - cannot generate report")
+        
+        try:
+            stream = self.llm.astream(self._build_report_prompt(query, context_docs))
+            try:
+                async for chunk in stream:
+                    if chunk.content:
+                        yield chunk.content
+            finally:
+                await stream.aclose()
+            
+            logger.info("Report generated successfully (streamed)")
+            
+        except Exception as e:
+            logger.error(f"Error generating report: {e}")
+            raise RuntimeError(f"Failed to generate report with LLM: {e}")
+    
+    def _build_report_prompt(self, query: str, context_docs: List[Document]) -> str:
+        """レポート生成用のプロンプトを作成"""
+        # コンテキストの準備
+        context = "\n\n---\n\n".join([
+            f"**出典**: {doc.metadata}\n**内容**: {doc.page_content}"
+            for doc in context_docs
+        ])
+        
+        return _REPORT_PROMPT.format_map({
+            "question": query,
+            "context": context
+        })
+    
     async def save_vector_store(self, path: str = "./vector_store_cache"):
-        """ベクトルストアをローカルに保存"""
+        """ベクトルストアをローカルに保存（FAISS.load_local と互換の index.faiss / index.pkl）
+
+        シリアライズはスレッドで行い、書き込みは aiofiles でイベントループを止めずに行う。
+        一時ファイルに書き出してから置き換え、書き込み途中のファイルを読み込まないようにする。
+        """
         if self.vector_store:
             try:
-                await asyncio.to_thread(
-                    self.vector_store.save_local,
-                    path
+                vector_store = self.vector_store
+                index_blob, docstore_blob = await asyncio.to_thread(
+                    lambda: (
+                        faiss.serialize_index(vector_store.index).tobytes(),
+                        pickle.dumps((vector_store.docstore, vector_store.index_to_docstore_id))
+                    )
                 )
+                
+                os.makedirs(path, exist_ok=True)
+                for filename, blob in (("index.faiss", index_blob), ("index.pkl", docstore_blob)):
+                    file_path = os.path.join(path, filename)
+                    async with aiofiles.open(file_path + ".tmp", "wb") as f:
+                        await f.write(blob)
+                    os.replace(file_path + ".tmp", file_path)
+                
                 logger.info(f"Vector store saved to {path}")
             except Exception as e:
                 logger.error(f"Error saving vector store: {e}")
     
+    def schedule_save_vector_store(self, delay: Optional[float] = None):
+        """ベクトルストアの保存を予約（待機中の保存要求はまとめて1回だけ書き込む）"""
+        self._vector_store_dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_now = asyncio.Event()
+            self._save_task = asyncio.create_task(
+                self._delayed_save_vector_store(_VECTOR_STORE_SAVE_DELAY if delay is None else delay)
+            )
+    
+    async def _delayed_save_vector_store(self, delay: float):
+        try:
+            await asyncio.wait_for(self._save_now.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        # 保存中に新たな保存要求があった場合は、もう一度保存する
+        while self._vector_store_dirty:
+            self._vector_store_dirty = False
+            await self.save_vector_store()
+    
+    async def flush_vector_store(self):
+        """予約済みの保存を直ちに実行して完了を待つ（シャットダウン時に使用）"""
+        if self._save_task is not None and not self._save_task.done():
+            self._save_now.set()
+            await self._save_task
+        elif self._vector_store_dirty:
+            self._vector_store_dirty = False
+            await self.save_vector_store()
+    
     
     def _filter_low_quality_sources(self, documents: List[Document]) -> List[Document]:
         """低品質なソース（Google検索結果など）をフィルタリング"""
@@ -766,6 +902,29 @@ class RAGPipeline:
         
         return filtered_docs
     
+    def deduplicate_documents(self, documents: List[Document]) -> List[Document]:
+        """ソース内で同じID・URL・本文のドキュメントを除去（ベクトル化の重複計算を防ぐ）"""
+        seen = set()
+        unique_docs = []
+        for doc in documents:
+            metadata = doc.metadata
+            key = metadata.get("id") or metadata.get("url")
+            if not key:
+                key = hashlib.blake2b(doc.page_content.encode("utf-8"), digest_size=16).digest()
+            key = (metadata.get("source", ""), key)
+            if key in seen:
+                continue
+            seen.add(key)
+            unique_docs.append(doc)
+        
+        if len(unique_docs) < len(documents):
+            logger.info(f"Removed {len(documents) - len(unique_docs)} duplicate documents ({len(unique_docs)}/{len(documents)} kept)")
+        return unique_docs
+    
+    def analyze_source_distribution(self, documents: List[Document]) -> Dict[str, int]:
+        """ソース別のドキュメント数を集計"""
+        return dict(Counter(doc.metadata.get("source", "") for doc in documents))
+    
     def _is_search_result_page(self, url: str, title: str, content: str) -> bool:
         """検索結果ページかどうかを判定"""
         
@@ -887,7 +1046,6 @@ class RAGPipeline:
     def _is_fetchable_url(self, url: str) -> bool:
         """Check if URL is suitable for web fetching"""
         try:
-            from urllib.parse import urlparse
             parsed = urlparse(url)
             
             # Only HTTP/HTTPS
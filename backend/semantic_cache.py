@@ -0,0 +1,265 @@
+"""
+Semantic Cache for LLM Query Generation
+Reuses LLM results for paraphrased queries via embedding similarity
+"""
+
+import os
+import copy
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+import logging
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """同時に要求された埋め込みを短い待ち時間でまとめ、1回のバッチ呼び出しで計算する
+
+    max_wait 秒待つか max_batch 件溜まった時点で embed_documents を呼び出し、
+    各要求の Future に対応するベクトルを返す。同じバッチ内の同一テキストは1回だけ計算する。
+    """
+
+    def __init__(self, embeddings, max_batch: int = 16, max_wait: float = 0.005):
+        self.embeddings = embeddings
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> List[float]:
+        """テキストの埋め込みを取得（他の要求とまとめて計算される）"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        """溜まっている要求をバッチとして送り出す"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if hasattr(self.embeddings, "aembed_documents"):
+            return await self.embeddings.aembed_documents(texts)
+        return await asyncio.to_thread(self.embeddings.embed_documents, texts)
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            result = await self._embed_documents(texts)
+            if len(result) != len(texts):
+                raise ValueError(f"Embedding returned {len(result)} vectors for {len(texts)} texts")
+            vectors = dict(zip(texts, result))
+
+            if len(texts) > 1:
+                logger.debug(f"Embedded {len(texts)} texts in one batch")
+            for text, future in batch:
+                if not future.done():
+                    future.set_result(vectors[text])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            # 未解決の要求を残すと呼び出し元が待ち続けるため、全て例外で解決する
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class SemanticCache:
+    """クエリ埋め込みのコサイン類似度で LLM の結果を再利用するキャッシュ
+
+    名前空間（分析・キーワード生成など）ごとに正規化済み埋め込みを
+    IndexFlatIP に格納し、内積 = コサイン類似度がしきい値を超えた場合に
+    保存済みの結果を返す。
+    """
+
+    def __init__(self, embeddings, threshold: Optional[float] = None, max_entries: int = 1000, ttl_seconds: Optional[float] = None):
+        self.embeddings = embeddings
+        self.threshold = threshold if threshold is not None else float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+        self.max_entries = max_entries
+        # エントリの有効期間（秒）。期限切れのエントリはヒットとして扱わない
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+        self._indexes: Dict[str, Any] = {}
+        self._values: Dict[str, List[Any]] = {}
+        self._timestamps: Dict[str, List[float]] = {}
+        # 同じクエリ文字列の埋め込みは複数の名前空間で使い回す
+        self._embedding_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._embedding_cache_size = 256
+        # 同時に発生した埋め込み要求は1回のバッチ呼び出しにまとめる
+        self._batcher = EmbeddingBatcher(embeddings)
+
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        """テキストを正規化済み埋め込みに変換（失敗時は None）"""
+        cached = self._embedding_cache.get(text)
+        if cached is not None:
+            self._embedding_cache.move_to_end(text)
+            return cached
+
+        try:
+            vector = await self._batcher.embed(text)
+            emb = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+            faiss.normalize_L2(emb)
+        except Exception as e:
+            logger.warning(f"Semantic cache embedding failed: {e}")
+            return None
+
+        self._embedding_cache[text] = emb
+        if len(self._embedding_cache) > self._embedding_cache_size:
+            self._embedding_cache.popitem(last=False)
+        return emb
+
+    def lookup(self, namespace: str, emb: Optional[np.ndarray]) -> Optional[Any]:
+        """類似度がしきい値を超えるエントリがあれば、そのコピーを返す"""
+        index = self._indexes.get(namespace)
+        if emb is None or index is None or index.ntotal == 0 or index.d != emb.shape[1]:
+            return None
+
+        # 上位候補のうち、しきい値を超えかつ期限内の最も類似したエントリを返す
+        scores, ids = index.search(emb, min(4, index.ntotal))
+        expires_before = time.time() - self.ttl_seconds
+        timestamps = self._timestamps[namespace]
+        for score, idx in zip(scores[0], ids[0]):
+            if idx < 0 or score < self.threshold:
+                break
+            if timestamps[idx] < expires_before:
+                continue
+            logger.info(f"Semantic cache hit [{namespace}]: similarity={score:.3f}")
+            return copy.deepcopy(self._values[namespace][idx])
+
+        return None
+
+    def store(self, namespace: str, emb: Optional[np.ndarray], value: Any):
+        """結果を保存（上限を超えた場合は古いエントリから破棄）"""
+        if emb is None:
+            return
+
+        index = self._indexes.get(namespace)
+        if index is None or index.d != emb.shape[1]:
+            index = faiss.IndexFlatIP(emb.shape[1])
+            self._indexes[namespace] = index
+            self._values[namespace] = []
+            self._timestamps[namespace] = []
+
+        values = self._values[namespace]
+        timestamps = self._timestamps[namespace]
+        if index.ntotal >= self.max_entries:
+            drop = max(index.ntotal // 2, 1)
+            index.remove_ids(np.arange(drop, dtype=np.int64))
+            del values[:drop]
+            del timestamps[:drop]
+
+        index.add(emb)
+        values.append(copy.deepcopy(value))
+        timestamps.append(time.time())
+
+    def clear(self):
+        """全ての名前空間を破棄"""
+        self._indexes.clear()
+        self._values.clear()
+        self._timestamps.clear()
+        self._embedding_cache.clear()
+
+
+# 正規化時に末尾から取り除く文末の句読点（ASCII と全角）
+_TRAILING_SENTENCE_PUNCT = "?!.。！？． "
+
+
+def normalize_query(query: str) -> str:
+    """完全一致キャッシュ用にクエリを正規化
+
+    大文字小文字・空白の違いと末尾の句読点のみを無視する。語順や語中の記号
+    （"C++" と "C#"、"A vs B" と "B vs A" など）は意味が変わるため保持する。
+    """
+    return " ".join(query.casefold().split()).rstrip(_TRAILING_SENTENCE_PUNCT)
+
+
+class QueryResultCache:
+    """検索パイプライン全体の結果をクエリ単位で再利用するキャッシュ
+
+    1段目は正規化したクエリの完全一致、2段目はクエリ埋め込みの類似度
+    （SemanticCache）で検索する。scope には除外フォルダ等、同じクエリでも
+    結果が変わる条件を渡す。
+    """
+
+    def __init__(self, embeddings=None, max_entries: int = 256, ttl_seconds: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "3600"))
+        self._exact: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._semantic = SemanticCache(embeddings, max_entries=max_entries, ttl_seconds=self.ttl_seconds) if embeddings is not None else None
+        # ヒット率の監視用カウンタ
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    async def get(self, query: str, scope: str = "") -> Optional[Any]:
+        """キャッシュ済みの結果のコピーを返す（無ければ None）"""
+        key = f"{scope}|{normalize_query(query)}"
+        entry = self._exact.get(key)
+        if entry is not None:
+            stored_at, value = entry
+            if time.time() - stored_at < self.ttl_seconds:
+                self._exact.move_to_end(key)
+                logger.info(f"Search cache hit (exact): {query}")
+                self.exact_hits += 1
+                return copy.deepcopy(value)
+            del self._exact[key]
+
+        value = None
+        if self._semantic is not None:
+            emb = await self._semantic.embed(query)
+            value = self._semantic.lookup(f"search:{scope}", emb)
+        if value is None:
+            self.misses += 1
+        else:
+            self.semantic_hits += 1
+        return value
+
+    async def set(self, query: str, value: Any, scope: str = ""):
+        """結果を保存（上限を超えた場合は最も古いエントリから破棄）"""
+        key = f"{scope}|{normalize_query(query)}"
+        self._exact[key] = (time.time(), copy.deepcopy(value))
+        self._exact.move_to_end(key)
+        while len(self._exact) > self.max_entries:
+            self._exact.popitem(last=False)
+
+        if self._semantic is not None:
+            # get() で計算済みの埋め込みはキャッシュから再利用される
+            emb = await self._semantic.embed(query)
+            self._semantic.store(f"search:{scope}", emb, value)
+
+    def stats(self) -> Dict[str, Any]:
+        """ヒット・ミスの回数と保持しているエントリ数"""
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._exact),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 3) if lookups else 0.0
+        }
+
+    def clear(self):
+        """全てのエントリを破棄"""
+        self._exact.clear()
+        if self._semantic is not None:
+            self._semantic.clear()
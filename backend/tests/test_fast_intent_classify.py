@@ -0,0 +1,55 @@
+"""
+ルールによるクエリ分類（_fast_intent_classify）のテスト
+"""
+
+import pytest
+
+from llm_query_generator import _fast_intent_classify
+
+
+@pytest.mark.parametrize("query", [
+    "会議はいつ？",
+    "リリースはいつだっけ",
+    "東京タワーはどこ？",
+    "どこで買える",
+    "誰が書いた",
+    "設立は何年",
+    "価格はいくら",
+    "When was it released",
+])
+def test_interrogative_queries_are_fact_checks(query):
+    analysis = _fast_intent_classify(query)
+    assert analysis is not None
+    assert analysis["intent"] == "事実確認"
+
+
+@pytest.mark.parametrize("query", [
+    "いつも使っているエディタの設定",
+    "いつか読みたいと思っていた本のメモ",
+    "どこか静かなカフェの候補リスト",
+    "誰かに共有した議事録の内容",
+    "何年も前に書いた研究ノート",
+    "I remember when we discussed the design",
+])
+def test_non_interrogative_forms_are_not_fact_checks(query):
+    analysis = _fast_intent_classify(query)
+    assert analysis is None or analysis["intent"] != "事実確認"
+
+
+@pytest.mark.parametrize("query", [
+    "問題解決の歴史についての資料まとめ",
+    "紛争解決に関する論文で読んだ内容",
+])
+def test_bare_kaiketsu_is_not_problem_solving(query):
+    analysis = _fast_intent_classify(query)
+    assert analysis is None or analysis["intent"] != "問題解決"
+
+
+@pytest.mark.parametrize("query", [
+    "ビルドエラーの解決方法",
+    "Dockerが起動しない問題を解決したい",
+])
+def test_problem_solving_queries(query):
+    analysis = _fast_intent_classify(query)
+    assert analysis is not None
+    assert analysis["intent"] == "問題解決"
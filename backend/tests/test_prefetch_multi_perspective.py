@@ -0,0 +1,49 @@
+"""
+多角的RAGクエリの先行生成（_prefetch_multi_perspective_queries）のテスト
+"""
+
+import asyncio
+
+from llm_query_generator import LLMQueryGenerator
+
+
+class _FakeLLM:
+    async def ainvoke(self, prompt):
+        raise AssertionError("LLM should not be called in this test")
+
+
+def _make_generator():
+    generator = LLMQueryGenerator(_FakeLLM(), supports_json_mode=False)
+    calls = []
+
+    async def fake_generate(original_query, initial_results=None, no_cache=False):
+        calls.append(original_query)
+        await asyncio.sleep(0)
+        return [f"{original_query} 概要", f"{original_query} 詳細"]
+
+    generator._generate_multi_perspective_queries = fake_generate
+    return generator, calls
+
+
+def test_prefetched_task_completes():
+    async def run():
+        generator, calls = _make_generator()
+        generator._prefetch_multi_perspective_queries("機械学習")
+        task = generator._prefetched_queries[("機械学習", False)]
+        result = await asyncio.wait_for(task, timeout=1)
+        assert result == ["機械学習 概要", "機械学習 詳細"]
+        assert calls == ["機械学習"]
+
+    asyncio.run(run())
+
+
+def test_later_call_reuses_prefetched_result():
+    async def run():
+        generator, calls = _make_generator()
+        generator._prefetch_multi_perspective_queries("機械学習")
+        result = await asyncio.wait_for(generator.generate_multi_perspective_queries("機械学習"), timeout=1)
+        assert result == ["機械学習 概要", "機械学習 詳細"]
+        assert calls == ["機械学習"]
+        assert ("機械学習", False) not in generator._prefetched_queries
+
+    asyncio.run(run())
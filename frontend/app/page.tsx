@@ -262,6 +262,9 @@ export default function Home() {
             setRagResults(newRagResults)
             setPendingRagResults(newRagResults) // 検索完了時に使用するため
           }
+        } else if (data.event === 'queued') {
+          // 同時実行数の上限に達している場合、検索開始まで待機中であることを表示
+          setProgress({ step: 0, stage: 'queued', message: data.message })
         } else if (data.event === 'search_complete') {
           const result = data.data
           setResult(result)
@@ -640,7 +643,7 @@ export default function Home() {
               <div className="flex items-center gap-3 mb-2">
                 {getProgressIcon(progress.stage)}
                 <span className="font-medium text-blue-900">
-                  ステップ {progress.step}: {progress.message}
+                  {progress.step > 0 ? `ステップ ${progress.step}: ` : ''}{progress.message}
                 </span>
               </div>
               {progress.details && (